@@ -1,25 +1,105 @@
 """\
-    This benchmark compares some python templating engines with Jinja 2 so
-    that we get a picture of how fast Jinja 2 is for a semi real world
-    template.  If a template engine is not installed the test is skipped.\
+    Benchmark suite. Runs each scenario repeatedly and reports
+    throughput, p50/p99 latency and peak memory. Jinja 2 is used
+    as a reference point if it is installed.
+
+    python bench.py run [-o results.json] [scenario ...]
+    python bench.py compare baseline.json results.json [-t 0.1]
+
+    compare exits with status 1 if a scenario is slower or uses more
+    memory than the baseline by more than the threshold. Timings are
+    only comparable between runs on the same machine.\
 """
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import subprocess  # nosec B404
 import sys
-from timeit import Timer
-
-from jinja2 import Environment as JinjaEnvironment
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
 
+import pyhtml
 from pyhtml import *
 
+try:
+    from jinja2 import Environment as JinjaEnvironment
+except ImportError:
+    JinjaEnvironment = None
+
+# Returned by scenarios which measure themselves in a subprocess.
+Measured = namedtuple('Measured', 'seconds peak_memory')
+
 context = {
     'page_title': 'mitsuhiko\'s benchmark',
-    'table': [dict(a=1,b=2,c=3,d=4,e=5,f=6,g=7,h=8,i=9,j=10) for x in range(10)]
+    'table': [dict(a=1, b=2, c=3, d=4, e=5, f=6, g=7, h=8, i=9, j=10) for x in range(10)]
 }
 
-jinja_template = JinjaEnvironment(
-    line_statement_prefix='%',
-    variable_start_string="${",
-    variable_end_string="}"
-).from_string("""\
+navigation = [
+    ('index.html', 'Index'),
+    ('downloads.html', 'Downloads'),
+    ('products.html', 'Products'),
+]
+
+
+def f_navigation(ctx):
+    for href, caption in navigation:
+        yield li(a(href=href)(caption))
+
+
+def f_table(ctx):
+    return (tr(td(cell) for cell in row.values()) for row in ctx['table'])
+
+
+bigtable_template = html(
+    head(
+        title(Var('page_title'))
+    ),
+    body(
+        div(class_="header")(
+            h1(Var('page_title'))
+        ),
+        ul(class_="navigation")(f_navigation),
+        div(class_="table")(
+            table(f_table)
+        )
+    )
+)
+
+
+def bigtable():
+    return lambda: bigtable_template.render(**context)
+
+
+def bigtable_compiled():
+    template = bigtable_template.compile()
+    return lambda: template.render(**context)
+
+
+def bigtable_rows():
+    template = html(
+        head(title(Var('page_title'))),
+        body(
+            div(class_="header")(h1(Var('page_title'))),
+            ul(class_="navigation")(f_navigation),
+            div(class_="table")(table(Rows('table'))),
+        )
+    )
+    return lambda: template.render(**context)
+
+
+def bigtable_jinja():
+    if JinjaEnvironment is None:
+        return None
+    template = JinjaEnvironment(
+        line_statement_prefix='%',
+        variable_start_string="${",
+        variable_end_string="}"
+    ).from_string("""\
 <!doctype html>
 <html>
   <head>
@@ -30,11 +110,7 @@ jinja_template = JinjaEnvironment(
       <h1>${page_title|e}</h1>
     </div>
     <ul class="navigation">
-    % for href, caption in [
-        ('index.html', 'Index'),
-        ('downloads.html', 'Downloads'),
-        ('products.html', 'Products')
-      ]
+    % for href, caption in navigation
       <li><a href="${href|e}">${caption|e}</a></li>
     % endfor
     </ul>
@@ -42,7 +118,7 @@ jinja_template = JinjaEnvironment(
       <table>
       % for row in table
         <tr>
-        % for cell in row
+        % for cell in row.values()
           <td>${cell}</td>
         % endfor
         </tr>
@@ -52,65 +128,297 @@ jinja_template = JinjaEnvironment(
   </body>
 </html>\
 """)
+    return lambda: template.render(navigation=navigation, **context)
 
-def test_jinja():
-    jinja_template.render(context)
 
+# Trees below are built on every run, otherwise
+# their output would be memoized after the first run.
 
-def f_navigation(ctx):
-    for href, caption in [
-            ('index.html', 'Index'),
-            ('downloads.html', 'Downloads'),
-            ('products.html', 'Products')]:
-        yield li(a(href=href)(caption))
+def deep_nesting(depth=1000):
+    def run():
+        t = p('x')
+        for _ in range(depth):
+            t = div(t)
+        return t.render(_pretty=False)
+    return run
 
-def f_table(ctx):
-    return (tr(
-        td(cell) for cell in row
-    ) for row in ctx['table'])
 
-pyhtml_template = html(
-    head(
-        title(var('page_title'))
-    ),
-    body(
-        div(class_="header")(
-            h1(var('page_title'))
-        ),
-        ul(class_="navigation")(f_navigation),
-        div(class_="table")(
-            table(f_table)
-        )
-    )
-)
+def wide_list(n=10000):
+    return lambda: ul([li('item %d' % i) for i in range(n)]).render()
+
+
+links = [('/item/%d' % i, 'Item %d' % i) for i in range(1000)]
+links_tree = ul(lambda ctx: (li(a(href=href)(caption)) for href, caption in ctx['links']))
+links_for_each = ul(ForEach('links', li(
+    a(href=lambda ctx: ctx['item'][0])(lambda ctx: ctx['item'][1]))))
+
+
+def link_list():
+    return lambda: links_tree.render(links=links)
+
+
+def link_list_for_each():
+    return lambda: links_for_each.render(links=links)
+
+
+def escape_heavy(n=1000):
+    texts = ['<b>"%d" & \'x\'</b>' % i for i in range(n)]
+    return lambda: div(p(text) for text in texts).render()
+
+
+def attribute_heavy(n=1000):
+    def run():
+        return div([a(href='/item/%d' % i, class_='link', id='item-%d' % i,
+                      title='Item <%d>' % i, data_id=i, data_kind='x', aria_label='item',
+                      target='_blank')('x')
+                    for i in range(n)]).render()
+    return run
+
+
+def layout(n):
+    tag = div(Block('content'))
+    for i in range(n):
+        tag = section(h2(Block('title%d' % i)), tag, p(Block('footer%d' % i)))
+    return html(head(title(Block('title'))), body(tag))
+
+
+def block_heavy(n=200):
+    def run():
+        t = layout(n)
+        for i in range(n):
+            t['title%d' % i] = 'title'
+            t['footer%d' % i] = 'footer'
+        t['content'] = div(Block('content'))
+        t['content'] = 'content'
+        return t.render()
+    return run
+
+
+def copy_layout(rows=200):
+    base = layout(10)
+    base['content'] = table([tr(class_='row')(td(i), td(str(i))) for i in range(rows)],
+                            Block('extra'))
+
+    def run():
+        t = base.copy()
+        t['title'] = 'title'
+        t['extra'] = 'extra'
+        return t
+    return run
+
+
+def streaming(rows=1000):
+    ctx = dict(context, table=context['table'] * (rows // len(context['table'])))
+
+    def run():
+        for _ in bigtable_template.iter_render(_chunk_size=4096, **ctx):
+            pass
+    return run
+
+
+def render_to_file(rows=1000):
+    """Same page as streaming, encoded and written to a binary file."""
+    ctx = dict(context, table=context['table'] * (rows // len(context['table'])))
+    sink = open(os.devnull, 'wb')
+    atexit.register(sink.close)
+    return lambda: bigtable_template.render_to(sink, **ctx)
+
+
+def startup_page(sections=100):
+    return html(head(title(Var('page_title'))), body(
+        [section(class_='section', id='s%d' % i)(
+            h2('Section %d' % i),
+            p(class_='lead')('Static text of section %d.' % i),
+            ul(class_='navigation')(f_navigation),
+            div(class_=lambda ctx: 'x')(Var('page_title')),
+        ) for i in range(sections)],
+        Block('footer'),
+    ))
+
+
+def compile_cold():
+    page = startup_page()
+    return lambda: page.compile()
+
+
+def compile_cached():
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory)
+    cache = TemplateCache(directory)
+    page = startup_page()
+    page.compile(cache=cache)
+    return lambda: page.compile(cache=cache)
+
+
+def import_pyhtml():
+    """Cumulative import time of pyhtml in a new interpreter,
+    as reported by python -X importtime. Bytecode is cached."""
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    # Subprocesses only run this interpreter with fixed arguments.
+    def run():
+        if tracemalloc.is_tracing():
+            code = ('import tracemalloc; tracemalloc.start(); import pyhtml; '
+                    'print(tracemalloc.get_traced_memory()[1])')
+            out = subprocess.check_output(  # nosec B603
+                [sys.executable, '-c', code], cwd=cwd, env=env)
+            return Measured(None, int(out))
+
+        code = 'import pyhtml'
+        proc = subprocess.run(  # nosec B603
+            [sys.executable, '-X', 'importtime', '-c', code], cwd=cwd, env=env,
+            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        for line in proc.stderr.splitlines():
+            _, cumulative, name = line.split('|')
+            if name.strip() == 'pyhtml':
+                return Measured(int(cumulative) / 1e6, None)
+        raise RuntimeError('pyhtml not found in -X importtime output')
+    return run
+
+
+scenarios = [
+    ('bigtable', bigtable),
+    ('bigtable (compiled)', bigtable_compiled),
+    ('bigtable (rows)', bigtable_rows),
+    ('bigtable (jinja2)', bigtable_jinja),
+    ('deep nesting', deep_nesting),
+    ('wide list', wide_list),
+    ('link list', link_list),
+    ('link list (for each)', link_list_for_each),
+    ('escape heavy', escape_heavy),
+    ('attribute heavy', attribute_heavy),
+    ('block heavy', block_heavy),
+    ('copy', copy_layout),
+    ('streaming', streaming),
+    ('render to file', render_to_file),
+    ('compile (cold)', compile_cold),
+    ('compile (cached)', compile_cached),
+    ('import', import_pyhtml),
+]
+
+
+def percentile(sorted_values, q):
+    index = int(round(q * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def measure(fn, min_time=1.0, min_rounds=20, max_rounds=1000):
+    fn()  # warm up
+
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < max_rounds:
+        t0 = time.perf_counter()
+        rv = fn()
+        elapsed = time.perf_counter() - t0
+        latencies.append(rv.seconds if isinstance(rv, Measured) else elapsed)
+        if len(latencies) >= min_rounds and time.perf_counter() - started >= min_time:
+            break
+
+    tracemalloc.start()
+    rv = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if isinstance(rv, Measured):
+        peak = rv.peak_memory
+
+    latencies.sort()
+    return {
+        'rounds': len(latencies),
+        'ops_per_sec': len(latencies) / sum(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_memory_kb': peak / 1024.0,
+    }
+
+
+def run(args):
+    names = [name for name, _ in scenarios]
+    for name in args.scenarios:
+        if name not in names:
+            sys.exit('unknown scenario: %s (choose from %s)' % (name, ', '.join(names)))
+
+    results = {}
+    sys.stdout.write('%-20s%8s%12s%10s%10s%12s\n' % (
+        'scenario', 'rounds', 'ops/s', 'p50 ms', 'p99 ms', 'peak KiB'))
+    for name, setup in scenarios:
+        if args.scenarios and name not in args.scenarios:
+            continue
+        fn = setup()
+        if fn is None:
+            sys.stdout.write('%-20s*not installed*\n' % name)
+            continue
+        r = results[name] = measure(fn, min_time=args.min_time)
+        sys.stdout.write('%-20s%8d%12.1f%10.3f%10.3f%12.1f\n' % (
+            name, r['rounds'], r['ops_per_sec'], r['p50_ms'], r['p99_ms'], r['peak_memory_kb']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'pyhtml': pyhtml.__version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'scenarios': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)['scenarios']
+    with open(args.results) as f:
+        results = json.load(f)['scenarios']
+
+    regressions = 0
+    sys.stdout.write('%-20s%12s%12s%12s\n' % ('scenario', 'p50', 'p99', 'peak mem'))
+    for name, new in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            sys.stdout.write('%-20s%12s\n' % (name, 'new'))
+            continue
+        changes = []
+        flagged = False
+        for key in 'p50_ms', 'p99_ms', 'peak_memory_kb':
+            change = new[key] / old[key] - 1 if old[key] else 0.0
+            # p99 of short runs is noisy, it is reported but not flagged.
+            if change > args.threshold and key != 'p99_ms':
+                flagged = True
+            changes.append('%+.1f%%' % (change * 100))
+        regressions += flagged
+        mark = '  REGRESSION' if flagged else ''
+        sys.stdout.write('%-20s%12s%12s%12s%s\n' % ((name,) + tuple(changes) + (mark,)))
+
+    if regressions:
+        sys.stdout.write('%d scenario(s) regressed by more than %.0f%%\n' % (
+            regressions, args.threshold * 100))
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p_run = commands.add_parser('run', help='run scenarios')
+    p_run.add_argument('scenarios', nargs='*', help='scenarios to run, all by default')
+    p_run.add_argument('-o', '--output', help='save results as JSON')
+    p_run.add_argument('--min-time', type=float, default=1.0,
+                       help='seconds to run each scenario')
+    p_run.set_defaults(func=run)
+
+    p_compare = commands.add_parser('compare', help='compare results with a baseline')
+    p_compare.add_argument('baseline')
+    p_compare.add_argument('results')
+    p_compare.add_argument('-t', '--threshold', type=float, default=0.1,
+                           help='allowed slowdown, 0.1 is 10%%')
+    p_compare.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
 
-def test_pyhtml():
-    pyhtml_template.render(**context)
-
-
-sys.stdout.write('\r' + '\n'.join((
-    '=' * 80,
-    'Template Engine BigTable Benchmark'.center(80),
-    '=' * 80,
-    __doc__,
-    '-' * 80
-)) + '\n')
-
-
-for test in 'jinja', 'pyhtml':
-    if locals()['test_' + test] is None:
-        sys.stdout.write('    %-20s*not installed*\n' % test)
-        continue
-    t = Timer(setup='from __main__ import test_%s as bench' % test,
-              stmt='bench()')
-    sys.stdout.write(' >> %-20s<running>' % test)
-    sys.stdout.flush()
-    sys.stdout.write('\r    %-20s%.4f seconds\n' % (test, t.timeit(number=50) / 50))
-sys.stdout.write('-' * 80 + '\n')
-sys.stdout.write('''\
-    WARNING: The results of this benchmark are useless to compare the
-    performance of template engines and should not be taken seriously in any
-    way.  It's testing the performance of simple loops and has no real-world
-    usefulnes.  It only used to check if changes on the Jinja code affect
-    performance in a good or bad way and how it roughly compares to others.
-''' + '=' * 80 + '\n')
+if __name__ == '__main__':
+    main()
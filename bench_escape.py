@@ -0,0 +1,56 @@
+"""\
+    Micro benchmark for escaping of text nodes and attribute values.
+    Compares pyhtml's escaping with the previous implementation which
+    made one replace() pass over the text for each special character.\
+"""
+import sys
+from functools import partial
+from timeit import Timer
+
+from pyhtml import _escape, _escape_all
+
+
+def escape_replace_all(text):
+    r = (
+        ('&', '&amp;'),
+        ('<', '&lt;'),
+        ('>', '&gt;'),
+        ('"', '&quot;'),
+        ("'", '&#x27;'), )
+    for k, v in r:
+        text = text.replace(k, v)
+    return text
+
+
+workloads = [
+    ('escape-free short', ['cell %d' % i for i in range(100)]),
+    ('escape-free long', ['lorem ipsum dolor sit amet ' * 40] * 100),
+    ('escape-heavy short', ['<b>"%d" & \'x\'</b>' % i for i in range(100)]),
+    ('escape-heavy long', ['<p class="x">Tom & Jerry</p>' * 40] * 100),
+]
+
+implementations = [
+    ('replace x5', lambda texts: [escape_replace_all(t) for t in texts]),
+    ('_escape', lambda texts: [_escape(t) for t in texts]),
+    ('_escape_all', _escape_all),
+]
+
+
+def main():
+    sys.stdout.write(__doc__ + '\n\n')
+    sys.stdout.write('%-20s' % 'workload')
+    for name, _ in implementations:
+        sys.stdout.write('%15s' % name)
+    sys.stdout.write('\n')
+
+    for workload, texts in workloads:
+        sys.stdout.write('%-20s' % workload)
+        for _, fn in implementations:
+            t = Timer(partial(fn, texts))
+            best = min(t.repeat(repeat=5, number=200)) / 200
+            sys.stdout.write('%13.1fus' % (best * 1e6))
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""\
+    Memory benchmark. Reports bytes allocated per node
+    for building large trees of different shapes.\
+"""
+import sys
+import tracemalloc
+
+from pyhtml import *
+
+
+def table_rows(n):
+    return table([tr([td(i) for i in range(10)]) for _ in range(n // 11)])
+
+
+def attribute_rows(n):
+    return ul([li(class_='item', data_id=i)(a(href='#%d' % i)('x'))
+               for i in range(n // 2)])
+
+
+def empty_tags(n):
+    return div([br() for _ in range(n)])
+
+
+def count_nodes(tag):
+    count = 0
+    stack = [tag]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, Tag):
+            count += 1
+            stack.extend(item.children)
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return count
+
+
+scenarios = [
+    ('table cells', table_rows),
+    ('tags with attributes', attribute_rows),
+    ('empty tags', empty_tags),
+]
+
+
+def main(n=100000):
+    sys.stdout.write(__doc__ + '\n\n')
+    sys.stdout.write('%-25s%10s%15s\n' % ('tree', 'nodes', 'bytes/node'))
+    for name, build in scenarios:
+        tracemalloc.start()
+        tree = build(n)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        nodes = count_nodes(tree)
+        sys.stdout.write('%-25s%10d%15.1f\n' % (name, nodes, float(size) / nodes))
+
+
+if __name__ == '__main__':
+    main()
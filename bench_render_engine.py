@@ -0,0 +1,109 @@
+"""\
+    Benchmark for the render engine. Compares pyhtml's stack based
+    renderer with the previous recursive renderer on deep and wide trees.
+    The recursive renderer fails with RecursionError on very deep trees.\
+"""
+import sys
+from functools import partial
+from io import StringIO
+from timeit import Timer
+from types import GeneratorType
+
+from pyhtml import *
+from pyhtml import INDENT, TagMeta
+
+
+def render_recursive(tag):
+    out = StringIO()
+    _render(tag, out, 0, True, {})
+    return out.getvalue()
+
+
+def _render(tag, out, indent, pretty, context):
+    if isinstance(tag, Block):
+        return _write_list(tag, tag.children, out, context, indent, pretty)
+
+    tag._begin_start_tag(out, indent, pretty)
+    tag._write_attributes(out, context)
+    tag._end_start_tag(out, pretty)
+
+    if tag.children and not tag.self_closing:
+        _write_list(tag, tag.children, out, context, indent + INDENT,
+                    tag._inner_pretty(pretty))
+
+    tag._write_end_tag(out, indent, pretty)
+
+
+def _write_list(owner, l, out, context, indent, pretty):
+    if owner._write_text_list(l, out, indent, pretty):
+        return
+
+    for i, child in enumerate(l):
+        if i != 0 and pretty and not owner.whitespace_sensitive:
+            out.write('\n')
+        _write_item(owner, child, out, context, indent, pretty)
+
+
+def _write_item(owner, item, out, context, indent, pretty):
+    if isinstance(item, Tag):
+        _render(item, out, indent, pretty, context)
+    elif isinstance(item, TagMeta):
+        owner._write_as_string(item, out, indent, pretty, escape=False)
+    elif callable(item):
+        _write_item(owner, item(context), out, context, indent, pretty)
+    elif isinstance(item, (GeneratorType, list, tuple)):
+        _write_list(owner, item, out, context, indent, pretty)
+    else:
+        owner._write_as_string(item, out, indent, pretty)
+
+
+def deep_tree(depth):
+    t = p('leaf')
+    for _ in range(depth):
+        t = div(t)
+    return t
+
+
+# Trees are built on every run, otherwise the output of the stack
+# renderer would be memoized after the first run. Building takes
+# the same time for both renderers.
+trees = [
+    ('deep 100', partial(deep_tree, 100)),
+    ('deep 500', partial(deep_tree, 500)),
+    ('deep 5000', partial(deep_tree, 5000)),
+    ('wide 1000', lambda: ul([li(a(href='#%d' % i)(i)) for i in range(1000)])),
+    ('wide 10000', lambda: div([span(i) for i in range(10000)])),
+]
+
+renderers = [
+    ('recursive', render_recursive),
+    ('stack', lambda tag: tag.render()),
+]
+
+
+def build_and_render(fn, build):
+    return fn(build())
+
+
+def main():
+    sys.stdout.write(__doc__ + '\n\n')
+    sys.stdout.write('%-20s' % 'tree')
+    for name, _ in renderers:
+        sys.stdout.write('%15s' % name)
+    sys.stdout.write('\n')
+
+    for tree_name, build in trees:
+        sys.stdout.write('%-20s' % tree_name)
+        for _, fn in renderers:
+            t = Timer(partial(build_and_render, fn, build))
+            try:
+                best = min(t.repeat(repeat=3, number=5)) / 5
+            except RecursionError:
+                sys.stdout.write('%15s' % 'RecursionError')
+            else:
+                sys.stdout.write('%13.2fms' % (best * 1e3))
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,8 @@ Simple HTML generator for Python.
 
 Usage:
 
+>>> from pyhtml import *
+
 Lets create a tag.
 
 >>> t = div()
@@ -142,6 +144,84 @@ Some tags have sensible defaults.
 <html></html>
 
 
+Tags can be compiled into a Template if the same tree is rendered many
+times. Static markup is rendered once and only dynamic parts are evaluated
+on each render.
+
+>>> t = div(p('static'), p(Var('name'))).compile()
+>>> print(t.render(name='Cenk'))
+<div>
+  <p>
+    static
+  </p>
+  <p>
+    Cenk
+  </p>
+</div>
+
+
+Large pages can be written to a binary file or socket in encoded chunks
+with render_to(), without building the whole page in memory first.
+
+>>> import io
+>>> out = io.BytesIO()
+>>> p(u'Türkçe').render_to(out, 'ascii', _pretty=False)
+>>> out.getvalue()
+b'<p>T&#252;rk&#231;e</p>'
+
+
+Tables of data can be rendered with Rows, which writes the markup of
+rows and cells without creating a tag for each of them.
+
+>>> print(table(Rows([(1, 'a'), (2, '<b>')])).render(_pretty=False))
+<table><tr><td>1</td><td>a</td></tr><tr><td>2</td><td>&lt;b&gt;</td></tr></table>
+
+
+ForEach renders a template for each item of a list. The template is
+compiled once, and its callables get the item from the context.
+
+>>> print(ul(ForEach('names', li(Var('item')))).render(names=['a', 'b'], _pretty=False))
+<ul><li>a</li><li>b</li></ul>
+
+
+Output of tags without callables, generators, lists or blocks in them is
+memoized when they are rendered again. Calling a tag or changing its
+children or attributes invalidates memoized output of the tags containing it.
+
+
+A tree shared by many threads can be frozen. Changing a frozen tree raises
+TypeError, so blocks are filled when rendering instead.
+
+>>> layout = div(Block('content')('default')).freeze()
+>>> print(layout.render(_blocks={'content': p('page')}, _pretty=False))
+<div><p>page</p></div>
+
+
+Subtrees that are expensive to render can be cached by a few context keys.
+Rendered output is reused until it expires or is evicted.
+
+>>> menu = Cached(ul(lambda ctx: [li(item) for item in ctx['items']]),
+...               key='role', ttl=60, maxsize=100)
+>>> print(div(menu).render(role='admin', items=['users']))
+<div>
+  <ul>
+    <li>
+      users
+    </li>
+  </ul>
+</div>
+>>> print(div(menu).render(role='admin', items=['not rendered']))
+<div>
+  <ul>
+    <li>
+      users
+    </li>
+  </ul>
+</div>
+>>> menu.hits, menu.misses
+(1, 1)
+
+
 Full example:
 
 >>> print(html(
@@ -186,21 +266,30 @@ Full example:
 
 """
 
-from __future__ import print_function
-
+import marshal
+import os
 import sys
-from copy import deepcopy
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from functools import partial
+from io import StringIO
+from itertools import islice
+from numbers import Number
 from types import GeneratorType
 
-import six
-
-if sys.version_info[0] >= 3:
-    from typing import Dict, List  # noqa
+# Only imported by type checkers, typing is slow to import.
+MYPY = False
+if MYPY:
+    from typing import Any, Dict, List, Optional, Set, Tuple  # noqa
 
 __version__ = '1.3.2'
 
 # The list will be extended by register_all function.
-__all__ = 'Tag Block Safe Var SelfClosingTag html script style form input_'.split()
+# Tag classes in it are created on first use, see __getattr__.
+__all__ = ('Tag Block Safe Cached Parallel Rows ForEach LRUCache SharedCache Var '
+           'Template TemplateCache RenderStats SelfClosingTag '
+           'render_many html script style form input_').split()
 
 tags = 'head body title div p h1 h2 h3 h4 h5 h6 u b i s a em strong span '\
        'font del_ ins ul ol li dd dt dl article section nav aside header '\
@@ -214,23 +303,183 @@ whitespace_sensitive_tags = 'code samp pre var kbd dfn'
 
 INDENT = 2
 
+# Default for the _pretty argument of render methods. Output has no
+# indentation and newlines between tags if false.
+PRETTY = True
+
+# Types which are written as text without further processing.
+_PLAIN_TYPES = (str, int, float)
+
+# Minimum size of chunks yielded by Tag.iter_render().
+CHUNK_SIZE = 8192
+
 
 def _escape(text):
-    r = (
-        ('&', '&amp;'),
-        ('<', '&lt;'),
-        ('>', '&gt;'),
-        ('"', '&quot;'),
-        ("'", '&#x27;'), )
-    for k, v in r:
-        text = text.replace(k, v)
+    # Most strings need no escaping. "in" checks are much cheaper
+    # than replace() calls which do not find anything.
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if "'" in text:
+        text = text.replace("'", '&#x27;')
     return text
 
 
+def _all_text(items):
+    return all(type(item) is str for item in items)
+
+
+def _escape_all(texts):
+    """Escapes a list of strings with a single _escape call.
+
+    Joining pays off for short strings only. Long strings
+    are escaped one by one.
+    """
+    joined = u'\0'.join(texts)
+    if len(joined) > 64 * len(texts) or joined.count(u'\0') != len(texts) - 1:
+        return [_escape(text) for text in texts]
+    return _escape(joined).split(u'\0')
+
+
+def _is_lazy(value):
+    # Attribute values which are converted to text on every render.
+    return callable(value) or not (
+        value is None or isinstance(value, (list, tuple, Number, str)))
+
+
+def _get_context(mapping, kwargs):
+    if mapping is None:
+        return kwargs
+    if kwargs:
+        raise TypeError('Context must be given either as _context '
+                        'or as keyword arguments')
+    return mapping
+
+
+class _Attributes(dict):
+    """Attributes of a Tag.
+
+    Keeps the serialized form of the attributes which is
+    discarded when the dict is modified.
+    """
+
+    __slots__ = ('serialized', 'owner', 'locked')
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.serialized = None
+        # Tag which is told when the attributes are modified, once memoized
+        # output or a template contains them. True for default_attributes
+        # of a class, which may be rendered by any tag of the class.
+        self.owner = None  # type: Any
+        # True if the tag is frozen.
+        self.locked = False
+
+    def __reduce__(self):
+        # Items would be set by __setitem__ before the slots are restored.
+        # The serialized form is not kept, output may be memoized again.
+        return (_Attributes, (dict(self), ), (None, {'locked': self.locked}))
+
+    def _modified(self):
+        if self.locked:
+            raise TypeError('attributes of a frozen tag cannot be changed')
+        self.serialized = None
+        owner = self.owner
+        if owner is True:
+            _invalidate()
+        elif owner is not None:
+            owner._changed()
+
+    def __setitem__(self, key, value):
+        self._modified()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._modified()
+        dict.__delitem__(self, key)
+
+    def clear(self):
+        self._modified()
+        dict.clear(self)
+
+    def pop(self, *args):
+        self._modified()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._modified()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self._modified()
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self._modified()
+        dict.update(self, *args, **kwargs)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+class _Option(object):
+    """Class attribute of a Tag which can be overridden per instance.
+
+    Tags have no __dict__, so per-instance values are kept in a dict
+    which is only allocated when an option is set on an instance.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.default_name = '_default_' + name
+
+    def __get__(self, tag, cls):
+        if tag is not None:
+            options = tag._options
+            if options is not None and self.name in options:
+                return options[self.name]
+        return getattr(cls, self.default_name)
+
+    def __set__(self, tag, value):
+        tag._changed()
+        if tag._options is None:
+            tag._options = {}
+        tag._options[self.name] = value
+
+
 class TagMeta(type):
     """Type of the Tag. (type(Tag) == TagMeta)
     """
 
+    # Class attributes which can be set on tag instances.
+    options = ('safe', 'sort_attributes')
+
+    def __new__(mcs, name, bases, namespace):
+        for option in mcs.options:
+            if option in namespace:
+                namespace['_default_' + option] = namespace.pop(option)
+                namespace[option] = _Option(option)
+
+        if 'default_attributes' in namespace:
+            # Instances without attributes share this dict.
+            namespace['default_attributes'] = _Attributes(namespace['default_attributes'])
+
+        return type.__new__(mcs, name, bases, namespace)
+
+    def __setattr__(cls, name, value):
+        if name in cls.options:
+            name = '_default_' + name
+        type.__setattr__(cls, name, value)
+        # Output of tags of the class and of its subclasses may change.
+        if any(issubclass(watched, cls) for watched in list(_watched_classes)):
+            _invalidate()
+
     def __str__(cls):
         """Renders as empty tag."""
         if cls.self_closing:
@@ -242,17 +491,29 @@ class TagMeta(type):
         return cls.__name__
 
 
-@six.python_2_unicode_compatible
-class Tag(six.with_metaclass(TagMeta, object)):  # type: ignore
+class Tag(metaclass=TagMeta):
+
+    __slots__ = ('_children', '_attributes', '_blocks', '_options', '_static', '_frozen',
+                 '_watchers')
 
     safe = False  # do not escape while rendering
+    sort_attributes = True  # False keeps insertion order (Python 3.7+)
     self_closing = False
     whitespace_sensitive = False
     default_attributes = {}  # type: Dict[str, str]
     default_attributes_if_defined = {}  # type: Dict[str, List[str, str]]
     doctype = None  # type: str
 
+    # Output of tags without dynamic content is memoized if true.
+    _memoize = True
+
     def __init__(self, *children, **attributes):
+        self._options = None  # type: Dict[str, Any]
+        self._static = False  # type: Any
+        self._frozen = False
+        # Tags with memoized output and ForEach nodes with templates
+        # containing this tag. They are told when it is changed.
+        self._watchers = None  # type: Optional[List[Tag]]
         _safe = attributes.pop('_safe', None)
         if _safe is not None:
             self.safe = _safe
@@ -263,19 +524,72 @@ class Tag(six.with_metaclass(TagMeta, object)):  # type: ignore
         if self.self_closing and children:
             raise Exception("Self closing tag can't have children")
 
-        self.children = children
+        self._children = children
 
-        self.blocks = {}  # type: Dict[str, List[Block]]
+        # None if there are no blocks below this tag, True if there are
+        # and the index is not built yet, or the index by block name.
+        self._blocks = None  # type: Any
         self._set_blocks(children)
 
-        self.attributes = self.default_attributes.copy()
-        self.attributes.update(attributes)
+        # Tags without attributes share default_attributes
+        # until attributes are accessed.
+        self._attributes = None  # type: _Attributes
+        if attributes:
+            self.attributes.update(attributes)
+
+            # Set default attributes based on existence of a tag.
+            for attribute, defaults in self.default_attributes_if_defined.items():
+                if attribute in self.attributes:
+                    for attr, val in defaults.items():
+                        self.attributes.setdefault(attr, val)
 
-        # Set default attributes based on existence of a tag.
-        for attribute, defaults in self.default_attributes_if_defined.items():
-            if attribute in self.attributes:
-                for attr, val in defaults.items():
-                    self.attributes.setdefault(attr, val)
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            if self._frozen:
+                attributes = _Attributes(self.default_attributes)
+                attributes.locked = True
+                return attributes
+            # The new dict is not memoized, assume it is going to be changed.
+            self._changed()
+            self._attributes = _Attributes(self.default_attributes)
+        return self._attributes
+
+    @attributes.setter
+    def attributes(self, attributes):
+        self._changed()
+        if type(attributes) is not _Attributes:
+            attributes = _Attributes(attributes)
+        self._attributes = attributes
+
+    @property
+    def children(self):
+        children = self._children
+        if not self._frozen and any(_is_frozen(child) for child in children):
+            # Frozen tags may be shared with other trees, see copy().
+            # They are replaced with copies which can be changed.
+            children = tuple(child._shallow_copy() if _is_frozen(child) else child
+                             for child in children)
+            self.children = children
+        return children
+
+    @children.setter
+    def children(self, children):
+        self._changed()
+        self._children = children
+        self._set_blocks(children)
+
+    @property
+    def blocks(self):
+        if type(self._blocks) is not dict:
+            self._blocks = _find_blocks(self._children) if self._blocks else {}
+        return self._blocks
+
+    def _attribute_dict(self):
+        # Same as self.attributes but does not allocate a new dict.
+        if self._attributes is None:
+            return self.default_attributes
+        return self._attributes
 
     def __call__(self, *children, **options):
         if self.self_closing:
@@ -286,24 +600,24 @@ class Tag(six.with_metaclass(TagMeta, object)):  # type: ignore
             self.safe = _safe
 
         self.children = children
-        self._set_blocks(children)
         return self
 
     def __repr__(self):
-        if self.attributes and not self.children:
+        attributes = self._attribute_dict()
+        if attributes and not self._children:
             return "%s(%s)" % (self.name, self._repr_attributes())
-        elif self.children and not self.attributes:
+        elif self._children and not attributes:
             return "%s(%s)" % (self.name, self._repr_children())
-        elif self.attributes and self.children:
+        elif attributes and self._children:
             return "%s(%s)(%s)" % (self.name, self._repr_attributes(), self._repr_children())
         else:
             return "%s()" % self.name
 
     def _repr_attributes(self):
-        return ', '.join("%s=%r" % (key, value) for key, value in six.iteritems(self.attributes))
+        return ', '.join("%s=%r" % (key, value) for key, value in self._attribute_dict().items())
 
     def _repr_children(self):
-        return ', '.join(repr(child) for child in self.children)
+        return ', '.join(repr(child) for child in self._children)
 
     def __str__(self):
         return self.render()
@@ -313,86 +627,388 @@ class Tag(six.with_metaclass(TagMeta, object)):  # type: ignore
         return self.__class__.__name__
 
     def copy(self):
-        return deepcopy(self)
+        """Returns a copy of the tag whose blocks can be filled independently.
+
+        Only the tags on the path from this tag to a Block are copied.
+        Subtrees without blocks are shared with the original and frozen,
+        see freeze(). Reading children of a tag which is not frozen
+        replaces the frozen tags in them with copies, so both trees can
+        still be changed through children. Lists are shared.
+        """
+        # Copy the tags on the paths first, then link them together.
+        # A Block may be reachable from several paths, it is copied once.
+        copies = {}  # type: Dict[int, Tag]
+        stack = [self]
+        while stack:
+            tag = stack.pop()
+            if id(tag) in copies:
+                continue
+            copies[id(tag)] = tag._shallow_copy()
+            stack.extend(child for child in tag._children if _has_blocks(child))
+            if type(tag._blocks) is dict:
+                for blocks in tag._blocks.values():
+                    stack.extend(blocks)
+
+        shared = []  # type: List[Any]
+        for new in copies.values():
+            shared.extend(child for child in new._children if id(child) not in copies)
+            new._children = tuple(copies.get(id(child), child) for child in new._children)
+            if type(new._blocks) is dict:
+                new._blocks = {name: [copies[id(block)] for block in blocks]
+                               for name, blocks in new._blocks.items()}
+        _freeze(shared)
+        return copies[id(self)]
+
+    def _shallow_copy(self):
+        cls = type(self)
+        new = cls.__new__(cls)
+        for name in _slot_names(cls):
+            setattr(new, name, getattr(self, name))
+        if hasattr(self, '__dict__'):
+            new.__dict__.update(self.__dict__)
+        new._frozen = False
+        new._watchers = None
+        if new._static is not False:
+            # Memoized output is not shared with the copy.
+            new._static = True
+        if self._attributes is not None:
+            new._attributes = _Attributes(self._attributes)
+            new._attributes.serialized = self._attributes.serialized
+        if self._options:
+            new._options = dict(self._options)
+        return new
+
+    def __getstate__(self):
+        # Slots are pickled explicitly, so any protocol can be used.
+        # Memoized output is only valid in the process which rendered it.
+        state = {name: getattr(self, name) for name in _slot_names(type(self))
+                 if hasattr(self, name)}
+        if state.get('_static') is not False:
+            state['_static'] = True
+        state['_watchers'] = None
+        return (getattr(self, '__dict__', None), state)
+
+    def freeze(self):
+        """Makes the tree immutable and returns the tag.
+
+        Calling, filling blocks of, or changing attributes or options of
+        tags in a frozen tree raise TypeError. Blocks are filled with the
+        _blocks argument of render methods instead, so a frozen tree can be
+        rendered by many threads at once. copy() returns a tree which can
+        be changed again. Lists in the tree are not frozen.
+        """
+        _freeze([self])
+        return self
+
+    def compile(self, pretty=None, cache=None):
+        """Returns a Template which renders the same output as this tag.
+
+        Static markup is serialized once, here. Only callables, generators,
+        blocks and lazy attributes are evaluated when the template is rendered.
+
+        If cache is a TemplateCache, the template is loaded from it
+        when the tree has not changed since it was saved.
+        """
+        if pretty is None:
+            pretty = PRETTY
+        if cache is not None:
+            return cache.compile(self, pretty)
+
+        plan = _PlanBuilder()
+        _Compiler(plan).render(self, self, 0, pretty)
+        return Template(plan.chunks())
+
+    def render(self, _out=None, _indent=0, _pretty=None, _context=None,
+               _executor=None, _stats=None, _blocks=None, **context):
+        """Renders the tag and returns the output.
 
-    def render(self, _out=None, _indent=0, **context):
+        Context can be given as keyword arguments or as any mapping
+        in _context. The mapping is passed to callables without copying.
+
+        Children of Parallel nodes are rendered concurrently if a
+        concurrent.futures executor is given in _executor.
+
+        Time spent and bytes written by each tag, block and callable are
+        recorded if _stats is a RenderStats. If it is a callable, it is
+        called with a new RenderStats after rendering.
+
+        _blocks maps block names to content which is rendered in place of
+        the content of the blocks, without changing the tree.
+        """
         if _out is None:
-            _out = six.StringIO(u'')
+            _out = StringIO()
+        if _pretty is None:
+            _pretty = PRETTY
+
+        self._render(_out, _indent, _pretty, _get_context(_context, context),
+                     _executor, _stats, _blocks)
+        return _out.getvalue()
 
+    def _render(self, out, indent, pretty, context, executor=None, stats=None, blocks=None):
+        if stats is None:
+            _Renderer(out, context, executor, blocks).render(self, self, indent, pretty)
+            return
+
+        hook = None
+        if not isinstance(stats, RenderStats):
+            hook, stats = stats, RenderStats()
+        renderer = _ProfilingRenderer(out, context, executor, stats, blocks)
+        renderer.render(self, self, indent, pretty)
+        if hook is not None:
+            hook(stats)
+
+    def _expand(self, renderer, owner, indent, pretty):
+        # Called by _Renderer with the tag whose content this tag is.
+        # Writes the start tag and pushes the children and the end tag
+        # onto the stack to be rendered later.
+        static = self._static
+        if static is True:
+            # Output is memoized if the tag is rendered again.
+            if renderer.memoize:
+                self._static = _RENDERED
+        elif static is not False and renderer.memoize:
+            output = self._static_output(indent, pretty)
+            if output is not None:
+                renderer.out.write(output)
+                return
+
+        self._begin_start_tag(renderer.out, indent, pretty)
+        if self._attributes is None and not self.default_attributes:
+            pass
+        elif renderer.compiling:
+            self._compile_attributes(renderer.out)
+        else:
+            self._write_attributes(renderer.out, renderer.context)
+        self._end_start_tag(renderer.out, pretty)
+
+        children = self._children
+        if not children or self.self_closing:
+            self._write_end_tag(renderer.out, indent, pretty)
+        elif len(children) == 1 and isinstance(children[0], _PLAIN_TYPES):
+            # Shortcut for the common case of a tag with only text in it.
+            self._write_as_string(children[0], renderer.out, indent + INDENT,
+                                  self._inner_pretty(pretty))
+            self._write_end_tag(renderer.out, indent, pretty)
+        else:
+            renderer.stack.append(self._end_tag(indent, pretty))
+            renderer.push_list(self, children, indent + INDENT,
+                               self._inner_pretty(pretty))
+
+    def _expand_async(self, renderer, owner, indent, pretty):
+        # Async counterpart of _expand, called by pyhtml_async._AsyncRenderer.
+        # Returns an async iterator which renders the tag.
+        return renderer.stream_tag(self, indent, pretty)
+
+    def _prefetch(self, renderer):
+        # Called by pyhtml_async._AsyncRenderer to start the coroutines
+        # below the tag before any output is written.
+        renderer.prefetch_tag(self)
+
+    def _static_output(self, indent, pretty):
+        """Returns memoized output of a static tag.
+
+        Output is memoized when the tag is rendered the second time,
+        so trees rendered only once do not pay for it.
+        Returns None if the output is not memoized.
+        """
+        # Read once, other threads rendering a shared tree may change it.
+        static = self._static
+        if static is True:
+            self._static = _RENDERED
+            return None
+
+        key = (indent, bool(pretty))
+        if static is not _RENDERED:
+            entry = static.get(key)
+            if entry is not None and entry[0] == _generation:
+                return entry[1]
+
+        generation = _generation
+        if not self._mark_static():
+            return None
+
+        renderer = _Renderer(_Buffer(), {})
+        renderer.memoize = False
+        renderer.render(self, self, indent, pretty)
+        output = renderer.out.getvalue()
+        if static is _RENDERED:
+            static = {}
+        static[key] = (generation, output)
+        self._static = static
+        return output
+
+    def _mark_static(self):
+        """Checks that the tree is still static and marks the tags in it,
+        so that changing them invalidates memoized output."""
+        stack = [self]  # type: List[Any]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, Tag):
+                if item._static is False:
+                    self._static = False
+                    return False
+                if item._static is True:
+                    item._static = _RENDERED
+                for part in item._serialized_attributes():
+                    if isinstance(part, tuple):
+                        # An attribute is set to a callable or an object after creation.
+                        self._static = False
+                        return False
+                item._add_watcher(self)
+                stack.extend(item._children)
+            elif isinstance(item, tuple):
+                stack.extend(item)
+            elif not _is_constant(item):
+                self._static = False
+                return False
+        return True
+
+    def _changed(self):
+        self._check_mutable()
+        if self._watchers is not None:
+            for watcher in self._watchers:
+                watcher._outdated()
+
+    def _add_watcher(self, watcher):
+        # Tells watcher when the tag or its attributes are changed.
+        _watched_classes.add(self.__class__)
+        if not self._frozen:
+            watchers = self._watchers
+            if watchers is None:
+                self._watchers = [watcher]
+            elif watcher not in watchers:
+                watchers.append(watcher)
+        attributes = self._attribute_dict()
+        if type(attributes) is _Attributes:
+            attributes.owner = self if attributes is self._attributes else True
+
+    def _outdated(self):
+        # Called when a tag in the memoized output of this tag is changed.
+        # Watchers are kept, so if the tree keeps changing between renders
+        # the output is not memoized again.
+        if self._static is not False:
+            self._static = True
+
+    def iter_render(self, _chunk_size=CHUNK_SIZE, _pretty=None, _context=None,
+                    _executor=None, _encoding=None, _blocks=None, **context):
+        """Renders the tag as a sequence of chunks.
+
+        Chunks are at least _chunk_size characters long, except the last one.
+        Generators in the tree are consumed while the output is being yielded.
+
+        Chunks are bytes if _encoding is given. Characters which cannot be
+        encoded are written as character references.
+        """
+        if _pretty is None:
+            _pretty = PRETTY
+        context = _get_context(_context, context)
+
+        out = _Buffer()
+        renderer = _Renderer(out, context, _executor, _blocks)
+        for _ in renderer.iterate(self, self, 0, _pretty, _chunk_size):
+            yield _encode(out.pop(), _encoding)
+
+        rest = out.pop()
+        if rest:
+            yield _encode(rest, _encoding)
+
+    def render_to(self, _out, _encoding='utf-8', _chunk_size=CHUNK_SIZE, _pretty=None,
+                  _context=None, _executor=None, _blocks=None, **context):
+        """Renders the tag into a binary file object such as a socket file.
+
+        Output is encoded and written in chunks of _chunk_size characters,
+        so the whole page is never held in memory as text and bytes.
+        """
+        for chunk in self.iter_render(_chunk_size, _pretty, _context, _executor,
+                                      _encoding, _blocks, **context):
+            _out.write(chunk)
+
+    def render_async(self, _pretty=None, _context=None, _blocks=None, **context):
+        """Coroutine version of render().
+
+        Children and attribute values may also be coroutine functions,
+        awaitables or async generators. Requires Python 3.6 or newer.
+        """
+        from pyhtml_async import render_async
+        return render_async(self, _get_context(_context, context), _pretty, _blocks)
+
+    def aiter_render(self, _chunk_size=CHUNK_SIZE, _pretty=None, _context=None,
+                     _blocks=None, **context):
+        """Async generator version of iter_render()."""
+        from pyhtml_async import aiter_render
+        return aiter_render(self, _get_context(_context, context),
+                            _chunk_size, _pretty, _blocks)
+
+    def _inner_pretty(self, pretty):
+        # Content of whitespace sensitive tags is always
+        # rendered same as in pretty mode.
+        return pretty or self.whitespace_sensitive
+
+    def _begin_start_tag(self, out, indent, pretty):
         # Write doctype
         if self.doctype:
-            _out.write(' ' * _indent)
-            _out.write(self.doctype)
-            _out.write('\n')
+            if pretty:
+                out.write(' ' * indent)
+            out.write(self.doctype)
+            if pretty:
+                out.write('\n')
 
         # Indent opening tag
-        _out.write(' ' * _indent)
+        if pretty:
+            out.write(' ' * indent)
 
         # Open tag
-        _out.write('<%s' % self.name)
-
-        self._write_attributes(_out, context)
+        out.write('<%s' % self.name)
 
+    def _end_start_tag(self, out, pretty):
         if self.self_closing:
-            _out.write('/>')
+            out.write('/>')
         else:
             # Close opening tag
-            _out.write('>')
+            out.write('>')
 
-            if self.children:
-                # Newline after opening tag
-                if not self.whitespace_sensitive:
-                    _out.write('\n')
-
-                # Write content
-                self._write_list(self.children, _out, context,
-                                 _indent + INDENT)
+            # Newline after opening tag
+            if pretty and self._children and not self.whitespace_sensitive:
+                out.write('\n')
 
-                if not self.whitespace_sensitive:
-                    # Newline after content
-                    _out.write('\n')
-                    # Indent closing tag
-                    _out.write(' ' * _indent)
+    def _write_end_tag(self, out, indent, pretty):
+        if not self.self_closing:
+            out.write(self._end_tag(indent, pretty))
 
-            # Write closing tag
-            _out.write('</%s>' % self.name)
+    def _end_tag(self, indent, pretty):
+        if pretty and self._children and not self.whitespace_sensitive:
+            # Newline after content and indent closing tag
+            return '\n%s</%s>' % (' ' * indent, self.name)
+        return '</%s>' % self.name
 
-        return _out.getvalue()
+    def _write_text_list(self, l, out, indent, pretty):
+        """Writes l if it only contains text. Returns True if written."""
+        if not (isinstance(l, list) and len(l) > 1 and not self.safe and _all_text(l)):
+            return False
 
-    def _write_list(self, l, out, context, indent=0):
-        for i, child in enumerate(l):
-            # Write newline between items
-            if i != 0 and not self.whitespace_sensitive:
+        separate = pretty and not self.whitespace_sensitive
+        for i, child in enumerate(_escape_all(l)):
+            if i != 0 and separate:
                 out.write('\n')
-
-            self._write_item(child, out, context, indent)
-
-    def _write_item(self, item, out, context, indent):
-        if isinstance(item, Tag):
-            item.render(out, indent, **context)
-        elif isinstance(item, TagMeta):
-            self._write_as_string(item, out, indent, escape=False)
-        elif callable(item):
-            rv = item(context)
-            self._write_item(rv, out, context, indent)
-        elif isinstance(item, (GeneratorType, list, tuple)):
-            self._write_list(item, out, context, indent)
-        else:
-            self._write_as_string(item, out, indent)
-
-    def _write_as_string(self, s, out, indent, escape=True):
-        if isinstance(s, six.text_type) and not isinstance(out, six.StringIO):
-            s = s.encode('utf-8')
-        elif s is None:
-            s = ''
-        elif not isinstance(s, six.string_types):
-            s = str(s)
+            self._write_as_string(child, out, indent, pretty, escape=False)
+        return True
+
+    def _write_as_string(self, s, out, indent, pretty=True, escape=True):
+        cls = s.__class__
+        if cls is not str:
+            if cls is int or cls is float:
+                # Numbers have nothing to escape and no lines to indent.
+                if pretty and not self.whitespace_sensitive:
+                    out.write(' ' * indent)
+                out.write(str(s))
+                return
+            s = '' if s is None else str(s)
 
         if escape and not self.safe:
             s = _escape(s)
 
         # Write content
-        if not self.whitespace_sensitive:
+        if pretty and not self.whitespace_sensitive:
             lines = s.splitlines(True)
             for line in lines:
                 out.write(' ' * indent)
@@ -401,80 +1017,1488 @@ class Tag(six.with_metaclass(TagMeta, object)):  # type: ignore
             out.write(s)
 
     def _write_attributes(self, out, context):
-        for key, value in sorted(self.attributes.items()):
-            # Some attribute names such as "class" conflict
-            # with reserved keywords in Python. These must
-            # be postfixed with underscore by user.
-            if key.endswith('_'):
-                key = key.rstrip('_')
+        for part in self._serialized_attributes():
+            if isinstance(part, tuple):
+                key, value = part
+                self._write_attribute(key, value, out, context)
+            else:
+                out.write(part)
+
+    def _serialized_attributes(self):
+        """Returns attributes as a list of rendered strings for static
+        values and (key, value) pairs for lazy values. Objects other than
+        text, numbers and sequences are lazy too, they may change after this.
+
+        The list is cached until attributes are modified.
+        """
+        attributes = self._attribute_dict()
+        if type(attributes) is not _Attributes:
+            # Attributes have been replaced with a plain dict.
+            self._attributes = attributes = _Attributes(attributes)
+
+        cache = attributes.serialized
+        if cache is None or cache[0] != self.sort_attributes:
+            items = attributes.items()
+            if self.sort_attributes:
+                items = sorted(items)
+
+            parts = []
+            buf = _Buffer()
+            for key, value in items:
+                if _is_lazy(value):
+                    if buf.tell():
+                        parts.append(buf.pop())
+                    parts.append((key, value))
+                else:
+                    self._write_attribute(key, value, buf, None)
+            if buf.tell():
+                parts.append(buf.pop())
+
+            attributes.serialized = cache = (self.sort_attributes, parts)
+
+        return cache[1]
+
+    def _write_attribute(self, key, value, out, context):
+        # Some attribute names such as "class" conflict
+        # with reserved keywords in Python. These must
+        # be postfixed with underscore by user.
+        if key.endswith('_'):
+            key = key.rstrip('_')
+
+        # Dash is preferred to underscore in attribute names.
+        key = key.replace('_', '-')
+
+        if callable(value):
+            value = value(context)
+
+        if value.__class__ is not str:
+            value = str(value)
+
+        value = _escape(value)
+
+        out.write(' %s="%s"' % (key, value))
+
+    def _compile_attributes(self, plan):
+        for part in self._serialized_attributes():
+            if isinstance(part, tuple):
+                plan.slot(partial(self._write_attribute, *part))
+            else:
+                plan.write(part)
+
+    def __setitem__(self, block_name, *children):
+        self._check_mutable()
+        index = self.blocks
+        for block in index[block_name]:
+            block(*children)
 
-            # Dash is preferred to underscore in attribute names.
-            key = key.replace('_', '-')
+        # Blocks with the same name in the new content replace the filled ones.
+        for name, blocks in _find_blocks(children).items():
+            if name == block_name:
+                index[name] = blocks
+            else:
+                index.setdefault(name, []).extend(blocks)
+
+    def _check_mutable(self):
+        if self._frozen:
+            raise TypeError('frozen tags cannot be changed, see Tag.freeze() and Tag.copy()')
+
+    def _set_blocks(self, children):
+        # Only mark the tag here, the index is built on first use.
+        # Also tells if the output of the tag can be memoized.
+        blocks = None
+        static = self._memoize
+        for child in children:
+            if isinstance(child, Tag):
+                if child._blocks or isinstance(child, Block):
+                    blocks = True
+                if child._static is False:
+                    static = False
+            elif static and not isinstance(child, _PLAIN_TYPES):
+                static = _all_static((child,))
+        self._blocks = blocks
+        self._static = static
+
+
+def _all_static(items):
+    # Tells if items render the same output every time.
+    for item in items:
+        if isinstance(item, Tag):
+            if item._static is False:
+                return False
+        elif isinstance(item, tuple):
+            if not _all_static(item):
+                return False
+        elif not _is_constant(item):
+            return False
+    return True
 
-            if callable(value):
-                value = value(context)
 
-            if isinstance(value, six.text_type) and not isinstance(
-                    out, six.StringIO):
-                value = value.encode('utf-8')
+def _is_constant(item):
+    # Lists may be changed in place after they are given as content.
+    return isinstance(item, TagMeta) or (_is_static(item) and not isinstance(item, list))
 
-            if not isinstance(value, six.string_types):
-                value = str(value)
 
-            value = _escape(value)
+# Memoized output of static tags and templates of ForEach nodes are
+# valid only if created in this generation. It changes when a class of
+# the tags in them is changed.
+_generation = 0
 
-            out.write(' %s="%s"' % (key, value))
+# Classes of the tags in memoized output and templates.
+_watched_classes = set()  # type: Set[type]
 
-    def __setitem__(self, block_name, *children):
-        for block in self.blocks[block_name]:
-            block(*children)
+# State of static tags which are rendered but have no memoized output.
+_RENDERED = object()
 
-        self._set_blocks(children, block_name=block_name)
 
-    def _set_blocks(self, children, block_name=None):
-        for child in children:
-            if isinstance(child, Block):
-                if child.block_name == block_name:
-                    self.blocks[child.block_name] = [child]
-                elif child.block_name not in self.blocks:
-                    self.blocks[child.block_name] = []
-                self.blocks[child.block_name].append(child)
-            elif isinstance(child, Tag):
-                for blocks in child.blocks.values():
-                    self._set_blocks(blocks, block_name=block_name)
+def _invalidate():
+    global _generation
+    _generation += 1
+
+
+# Names of the slots of Tag subclasses by class.
+_slots = {}  # type: Dict[type, tuple]
+
+
+def _slot_names(cls):
+    try:
+        return _slots[cls]
+    except KeyError:
+        names = []
+        for base in cls.__mro__:
+            slots = base.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots, )
+            names.extend(name for name in slots if name not in ('__dict__', '__weakref__'))
+        names = _slots[cls] = tuple(names)
+        return names
+
+
+def _freeze(stack):
+    # Tags which are frozen already are skipped with their subtrees,
+    # so copying the same tree again does not walk the shared parts.
+    while stack:
+        item = stack.pop()
+        if isinstance(item, Tag):
+            if item._frozen:
+                continue
+            item._frozen = True
+            if item._attributes is not None:
+                item._attributes.locked = True
+            stack.extend(item._children)
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+
+
+def _is_frozen(item):
+    return isinstance(item, Tag) and item._frozen
+
+
+def _has_blocks(item):
+    return isinstance(item, Tag) and (item._blocks or isinstance(item, Block))
+
+
+def _find_blocks(children):
+    """Returns blocks in children by name.
+
+    Tags without blocks are skipped and indexes of the tags in between
+    are not built, so the cost does not depend on the depth of blocks.
+    """
+    index = {}  # type: Dict[str, List[Block]]
+    stack = [child for child in reversed(children) if _has_blocks(child)]
+    while stack:
+        tag = stack.pop()
+        if isinstance(tag, Block):
+            # Blocks in the content of a block are indexed too, but a block
+            # hides the blocks with the same name in it. Content which
+            # replaces a block is handled by __setitem__.
+            found = _find_blocks(tag._children) if tag._blocks else {}
+            found[tag.block_name] = [tag]
+        elif type(tag._blocks) is dict:
+            found = tag._blocks
+        else:
+            stack.extend(child for child in reversed(tag._children) if _has_blocks(child))
+            continue
+
+        for name, blocks in found.items():
+            index.setdefault(name, []).extend(blocks)
+    return index
 
 
 class Block(Tag):
     """List of renderable items."""
 
+    __slots__ = ('block_name',)
+
+    # Blocks are filled on every request.
+    _memoize = False
+
     def __init__(self, name):
         super(Block, self).__init__()
         self.block_name = name
         self.children = ()
 
     def __repr__(self):
-        if not self.children:
+        if not self._children:
             return 'Block(%r)' % self.block_name
         else:
             return 'Block(%r)(%s)' % (self.block_name, self._repr_children())
 
-    def render(self, _out=None, _indent=0, **context):
-        if _out is None:
-            _out = six.StringIO(u'')
+    def _expand(self, renderer, owner, indent, pretty):
+        if renderer.compiling:
+            # Block contents may be replaced after compiling.
+            renderer.slot(owner, self, indent, pretty)
+        elif renderer.blocks is not None and self.block_name in renderer.blocks:
+            renderer.stack.append((self, renderer.blocks[self.block_name], indent, pretty))
+        else:
+            renderer.push_list(self, self._children, indent, pretty)
 
-        self._write_list(self.children, _out, context, _indent)
-        return _out.getvalue()
+    def _expand_async(self, renderer, owner, indent, pretty):
+        return renderer.stream_block(self, indent, pretty)
+
+    def _prefetch(self, renderer):
+        renderer.prefetch_block(self)
 
 
 class Safe(Block):
     """Helper for wrapping content that do not need escaping."""
 
+    __slots__ = ()
+
     safe = True
+    _memoize = True
 
     def __init__(self, *children, **options):
         super(Safe, self).__init__(None)
         super(Safe, self).__call__(*children, **options)
 
+    def _expand(self, renderer, owner, indent, pretty):
+        renderer.push_list(self, self._children, indent, pretty)
+
+    def _expand_async(self, renderer, owner, indent, pretty):
+        return renderer.stream_list(self, self._children, indent, pretty)
+
+    def _prefetch(self, renderer):
+        renderer.prefetch_tag(self)
+
+
+class Cached(Tag):
+    """Caches rendered output of its children.
+
+    key selects the cache entry from the render context. It may be a
+    context key, a sequence of context keys or a callable taking the context.
+    All contexts share a single entry if key is None. Entries are kept for
+    ttl seconds if it is given. cache is the storage, an LRUCache holding
+    maxsize entries is used if it is None.
+
+    Content of the blocks below the node is rendered to select
+    the entry as well, however they are filled.
+    """
+
+    __slots__ = ('key', 'ttl', 'cache', 'hits', 'misses')
+
+    _memoize = False
+
+    def __init__(self, *children, **options):
+        key = options.pop('key', None)
+        self.ttl = options.pop('ttl', None)
+        cache = options.pop('cache', None)
+        maxsize = options.pop('maxsize', 128)
+        super(Cached, self).__init__(*children, **options)
+
+        if key is None or callable(key):
+            self.key = key
+        elif isinstance(key, str):
+            self.key = lambda ctx: ctx.get(key)
+        else:
+            keys = tuple(key)
+            self.key = lambda ctx: tuple(ctx.get(k) for k in keys)
+
+        self.cache = LRUCache(maxsize) if cache is None else cache
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'Cached(%s)' % self._repr_children()
+
+    def _cache_key(self, context, indent, pretty, blocks=()):
+        # Output depends on where the subtree is rendered and
+        # on the rendered content of the blocks below the node.
+        key = self.key(context) if self.key is not None else None
+        if blocks:
+            return (key, indent, bool(pretty), tuple(blocks))
+        return (key, indent, bool(pretty))
+
+    def _blocks_below(self):
+        # Copies of the node share the cache, their blocks may be filled differently.
+        if not self._blocks:
+            return []
+        index = self.blocks
+        return [block for name in sorted(index) for block in index[name]]
+
+    def _lookup(self, key):
+        value = self.cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def _expand(self, renderer, owner, indent, pretty):
+        if renderer.compiling:
+            renderer.slot(owner, self, indent, pretty)
+            return
+
+        blocks = [(block.block_name, _render_string(block, block, renderer.context, 0, pretty,
+                                                    renderer.blocks))
+                  for block in self._blocks_below()]
+        key = self._cache_key(renderer.context, indent, pretty, blocks)
+        value = self._lookup(key)
+        if value is None:
+            out = _Buffer()
+            _Renderer(out, renderer.context, renderer.executor, renderer.blocks).render(
+                self, self._children, indent, pretty)
+            value = out.getvalue()
+            self.cache.set(key, value, self.ttl)
+        renderer.out.write(value)
+
+    def _expand_async(self, renderer, owner, indent, pretty):
+        return renderer.stream_cached(self, indent, pretty)
+
+    def _prefetch(self, renderer):
+        # Children are not evaluated if the output is cached.
+        pass
+
+
+class Parallel(Tag):
+    """Renders its children concurrently if the tree is rendered with
+    an executor. Output is the same as rendering them one by one.
+
+    Use it for siblings whose callables wait on I/O. Parallel nodes
+    below a Parallel node and in compiled templates are rendered in order.
+    """
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'Parallel(%s)' % self._repr_children()
+
+    def _expand(self, renderer, owner, indent, pretty):
+        if renderer.compiling:
+            renderer.slot(owner, self, indent, pretty)
+            return
+        if renderer.executor is None:
+            renderer.push_list(self, self._children, indent, pretty)
+            return
+
+        futures = [renderer.executor.submit(_render_string, self, child, renderer.context,
+                                            indent, pretty, renderer.blocks)
+                   for child in self._children]
+        try:
+            outputs = [future.result() for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+
+        separator = '\n' if pretty and not self.whitespace_sensitive else ''
+        renderer.out.write(separator.join(outputs))
+
+    def _expand_async(self, renderer, owner, indent, pretty):
+        # Coroutines are already awaited concurrently, it is a plain list here.
+        return renderer.stream_list(self, self._children, indent, pretty)
+
+
+class Rows(Tag):
+    """Renders rows of data as <tr> elements without creating a tag for
+    every row and cell. Output is the same as tr(td(value) for value in row)
+    for each row, values are written as escaped text.
+
+    data is a sequence of rows, a context key or a callable taking the
+    context. Rows may be mappings, whose values are written in order, or
+    sequences such as tuples and NumPy arrays. columns selects the values
+    of each row by key or index. formatters maps columns to callables
+    which convert values before they are written.
+    """
+
+    __slots__ = ('data', 'columns', 'formatters')
+
+    _memoize = False
+    # Markup is generated here, values are escaped when it is generated.
+    safe = True
+
+    # Number of rows generated and escaped at once.
+    batch_size = 100
+
+    def __init__(self, data, columns=None, formatters=None):
+        super(Rows, self).__init__()
+        if isinstance(data, str):
+            key = data
+            data = lambda ctx: ctx[key]
+        self.data = data
+        self.columns = None if columns is None else tuple(columns)
+        self.formatters = formatters or {}
+
+    def __repr__(self):
+        return 'Rows(%r)' % (self.data, )
+
+    def _expand(self, renderer, owner, indent, pretty):
+        if renderer.compiling:
+            renderer.slot(owner, self, indent, pretty)
+            return
+        # Batches are pushed one at a time like the items of a generator.
+        # They are not separated or indented again.
+        batches = self._batches(owner, renderer.context, indent, pretty)
+        renderer.stack.append((self, batches, indent, False, False))
+
+    def _expand_async(self, renderer, owner, indent, pretty):
+        # Rendered synchronously, coroutines in them are not awaited.
+        return renderer.stream_batches(self._batches(owner, renderer.context, indent, pretty))
+
+    def _prefetch(self, renderer):
+        pass
+
+    def _batches(self, owner, context, indent, pretty):
+        """Yields markup of the rows in batches of batch_size rows.
+        Rows are separated like the other content of owner."""
+        data = self.data(context) if callable(self.data) else self.data
+        rows = iter(data)
+        batch = list(islice(rows, self.batch_size))
+        if not batch:
+            return
+
+        columns, formatters = self._columns(batch[0])
+        mapping = columns is None and isinstance(batch[0], Mapping)
+        separator = '\n' if pretty and not owner.whitespace_sensitive else ''
+        previous = ''
+        while batch:
+            texts, sizes = self._cells(batch, columns, formatters, mapping)
+            if pretty:
+                yield previous + _pretty_rows(texts, sizes, indent, separator)
+            else:
+                yield _compact_rows(texts, sizes)
+            previous = separator
+            batch = list(islice(rows, self.batch_size))
+
+    def _columns(self, first):
+        # Returns the selected columns and their formatters. All columns
+        # of the first row are selected if there are formatters.
+        columns = self.columns
+        if columns is None and self.formatters:
+            columns = tuple(first) if isinstance(first, Mapping) else tuple(range(len(first)))
+        formatters = None
+        if columns is not None and self.formatters:
+            formatters = [self.formatters.get(column) for column in columns]
+        return columns, formatters
+
+    def _cells(self, batch, columns, formatters, mapping):
+        # Returns escaped text of the cells and the number of cells in each row.
+        texts = []
+        sizes = []
+        for row in batch:
+            if columns is not None:
+                values = [row[column] for column in columns]
+                if formatters is not None:
+                    values = [value if f is None else f(value)
+                              for f, value in zip(formatters, values)]
+            else:
+                values = row.values() if mapping else row
+            size = len(texts)
+            texts.extend(value if value.__class__ is str else _cell_text(value)
+                         for value in values)
+            sizes.append(len(texts) - size)
+        return _escape_all(texts), sizes
+
+
+def _cell_text(value):
+    if value is None:
+        return ''
+    if hasattr(value, '__await__'):
+        _not_awaited(value)
+    return str(value)
+
+
+def _compact_rows(texts, sizes):
+    lines = []
+    i = 0
+    for size in sizes:
+        cells = texts[i:i + size]
+        i += size
+        if cells:
+            lines.append('<tr><td>' + '</td><td>'.join(cells) + '</td></tr>')
+        else:
+            lines.append('<tr></tr>')
+    return ''.join(lines)
+
+
+def _pretty_rows(texts, sizes, indent, separator):
+    pad = ' ' * indent
+    cell_pad = ' ' * (indent + INDENT)
+    text_pad = ' ' * (indent + 2 * INDENT)
+    row_start, row_end = pad + '<tr>\n', '\n%s</tr>' % pad
+    cell_start, cell_end = cell_pad + '<td>\n', '\n%s</td>' % cell_pad
+
+    lines = []
+    i = 0
+    for size in sizes:
+        cells = texts[i:i + size]
+        i += size
+        lines.append(row_start + '\n'.join(
+            cell_start + _indent_text(text, text_pad) + cell_end for text in cells) + row_end)
+    return separator.join(lines)
+
+
+class ForEach(Tag):
+    """Renders template once for each item, without building its tags again.
+
+    items is an iterable, a context key or a callable taking the context.
+    template is compiled when it is first rendered, like Tag.compile(),
+    and again after it is changed. Lists in it are read when it is compiled.
+    Callables in it are called with the context of the item, which has
+    the item under the as_ key and falls back to the parent context.
+    """
+
+    __slots__ = ('items', 'as_', 'templates')
+
+    _memoize = False
+
+    def __init__(self, items, template, as_='item'):
+        super(ForEach, self).__init__(template)
+        if isinstance(items, str):
+            key = items
+            items = lambda ctx: ctx[key]
+        self.items = items
+        self.as_ = as_
+        # Generation and compiled template by indent, pretty and
+        # the rules of the tag it is rendered in.
+        self.templates = {}  # type: Dict[tuple, Tuple[int, Template]]
+
+    def __repr__(self):
+        return 'ForEach(%r, %s)' % (self.items, self._repr_children())
+
+    def _shallow_copy(self):
+        new = super(ForEach, self)._shallow_copy()
+        # Templates of the copy are compiled from its own children.
+        new.templates = {}
+        return new
+
+    def _expand(self, renderer, owner, indent, pretty):
+        if renderer.compiling:
+            renderer.slot(owner, self, indent, pretty)
+            return
+        batches = self._batches(owner, renderer.context, indent, pretty, renderer.blocks)
+        renderer.stack.append((_RAW, batches, indent, False, False))
+
+    def _expand_async(self, renderer, owner, indent, pretty):
+        # Rendered synchronously, coroutines in the template are not awaited.
+        return renderer.stream_batches(
+            self._batches(owner, renderer.context, indent, pretty, renderer.blocks))
+
+    def _prefetch(self, renderer):
+        # Coroutines in the template are not started, they cannot be awaited.
+        pass
+
+    def _template(self, owner, indent, pretty):
+        # The template is rendered as content of owner, with its rules
+        # for escaping and whitespace.
+        # Read once, _outdated() may replace it.
+        templates = self.templates
+        key = (indent, bool(pretty), owner.safe, owner.whitespace_sensitive)
+        entry = templates.get(key)
+        if entry is not None and entry[0] == _generation:
+            return entry[1]
+
+        generation = _generation
+        self._watch()
+        plan = _PlanBuilder()
+        _Compiler(plan).render(owner, self._children[0], indent, pretty)
+        template = Template(plan.chunks())
+        templates[key] = (generation, template)
+        return template
+
+    def _watch(self):
+        # Asks the tags which are compiled into the template
+        # to tell when they are changed.
+        stack = [self]  # type: List[Any]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, Tag):
+                if isinstance(item, Block) and not isinstance(item, Safe):
+                    # Content of blocks is rendered from the tree.
+                    continue
+                item._add_watcher(self)
+                stack.extend(item._children)
+            elif isinstance(item, (list, tuple)):
+                stack.extend(item)
+
+    def _outdated(self):
+        self.templates = {}
+
+    def _batches(self, owner, context, indent, pretty, blocks=None):
+        """Yields output of the items in chunks of about CHUNK_SIZE.
+        Items are separated like the other content of owner."""
+        items = self.items(context) if callable(self.items) else self.items
+        render = self._template(owner, indent, pretty)._function
+        separate = pretty and not owner.whitespace_sensitive
+        item_context = _ItemContext(context)
+        name = self.as_
+        out = _Buffer()
+        for i, item in enumerate(items):
+            if i and separate:
+                out.write('\n')
+            item_context[name] = item
+            render(out, item_context, blocks)
+            if out.tell() >= CHUNK_SIZE:
+                yield out.pop()
+        rest = out.pop()
+        if rest:
+            yield rest
+
+
+class _ItemContext(dict):
+    """Context of ForEach items. Keys which are not set
+    in it are looked up in the parent context."""
+
+    __slots__ = ('parent', )
+
+    def __init__(self, parent):
+        dict.__init__(self)
+        self.parent = parent
+
+    def __missing__(self, key):
+        return self.parent[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.parent
+
+    def get(self, key, default=None):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        return self.parent.get(key, default)
+
+
+def _indent_text(text, pad):
+    # Same as writing text with Tag._write_as_string() in pretty mode.
+    if not text:
+        return ''
+    if text.isprintable():
+        # No line breaks in it.
+        return pad + text
+    return ''.join(pad + line for line in text.splitlines(True))
+
+
+def _render_string(owner, item, context, indent, pretty, blocks):
+    # Runs in a worker of the executor. Nested Parallel nodes are rendered
+    # in order, waiting for them could use up workers of a bounded pool.
+    out = _Buffer()
+    _Renderer(out, context, blocks=blocks).render(owner, item, indent, pretty)
+    return out.getvalue()
+
+
+class LRUCache(object):
+    """In-process storage for Cached.
+
+    Evicts the least recently used entry when there are more than maxsize
+    entries. Expired entries are removed when they are read.
+    """
+
+    def __init__(self, maxsize=128, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.timer = timer
+        self.entries = OrderedDict()  # type: OrderedDict
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires <= self.timer():
+            return None
+        # Move to the end as the most recently used entry.
+        self.entries[key] = entry
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else self.timer() + ttl
+        self.entries.pop(key, None)
+        self.entries[key] = (expires, value)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class SharedCache(object):
+    """Storage for Cached which keeps entries in a mapping shared by processes.
+
+    Keys are converted to strings and prefixed with namespace, as done for
+    memcached or redis. The default store is a module level dict which
+    stands in for such a service in tests and development.
+    """
+
+    store = {}  # type: Dict[str, Any]
+
+    def __init__(self, namespace, store=None, timer=time.time):
+        self.namespace = namespace
+        if store is not None:
+            self.store = store
+        self.timer = timer
+
+    def _key(self, key):
+        return '%s:%r' % (self.namespace, key)
+
+    def get(self, key):
+        entry = self.store.get(self._key(key))
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires <= self.timer():
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else self.timer() + ttl
+        self.store[self._key(key)] = (expires, value)
+
+
+class RenderStats(object):
+    """Statistics collected by Tag.render(_stats=...).
+
+    nodes maps names of tags, blocks and callables to NodeStats, summed
+    over all renders with this object. stacks maps paths of names from the
+    root to the exclusive time spent there, see collapsed().
+    Children of static tags with memoized output are not recorded.
+    """
+
+    def __init__(self):
+        self.nodes = {}  # type: Dict[str, NodeStats]
+        self.stacks = {}  # type: Dict[tuple, float]
+
+    def __str__(self):
+        lines = ['%-40s%8s%12s%12s%10s' % ('name', 'calls', 'incl ms', 'excl ms', 'bytes')]
+        nodes = sorted(self.nodes.items(), key=lambda item: item[1].exclusive, reverse=True)
+        for name, node in nodes:
+            lines.append('%-40s%8d%12.3f%12.3f%10d' % (
+                name, node.calls, node.inclusive * 1000, node.exclusive * 1000, node.bytes))
+        return '\n'.join(lines)
+
+    def collapsed(self):
+        """Returns exclusive time in microseconds per stack in the collapsed
+        format read by flamegraph.pl and speedscope."""
+        lines = []
+        for path, seconds in sorted(self.stacks.items()):
+            frames = ';'.join(name.replace(';', ',').replace(' ', '_') for name in path)
+            lines.append('%s %d' % (frames, round(seconds * 1e6)))
+        return '\n'.join(lines) + '\n'
+
+
+class NodeStats(object):
+    """Totals for one name in RenderStats.
+
+    Inclusive time and bytes contain the children of the node.
+    Nested nodes with the same name are counted once in them.
+    """
+
+    __slots__ = ('calls', 'inclusive', 'exclusive', 'bytes')
+
+    def __init__(self):
+        self.calls = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.bytes = 0
+
+    def __repr__(self):
+        return 'NodeStats(calls=%d, inclusive=%.6f, exclusive=%.6f, bytes=%d)' % (
+            self.calls, self.inclusive, self.exclusive, self.bytes)
+
+
+class Template(object):
+    """Render plan created by Tag.compile().
+
+    Holds static markup as merged strings and dynamic parts as slots
+    which are evaluated with the context on every render. The plan is
+    also compiled to a Python function, its source is in the source
+    attribute.
+    """
+
+    def __init__(self, chunks, _generated=None):
+        self.chunks = chunks
+        if _generated is None:
+            _generated = _generate(chunks)
+        # Code creates the render function from the objects in names.
+        self.source, self._code, self._names = _generated
+        # Chunks with static text encoded, by encoding.
+        self._encoded = {}  # type: Dict[str, list]
+        namespace = {'escape': _escape, '_text': _text, 'render_item': _render_item}
+        # Source is generated by _CodeGenerator, constants in it are repr'd.
+        exec(self._code, namespace)  # nosec B102
+        self._function = namespace['make'](**self._names)
+
+    def __repr__(self):
+        return 'Template(%d chunks)' % len(self.chunks)
+
+    def __str__(self):
+        return self.render()
+
+    def render(self, _out=None, _context=None, _blocks=None, **context):
+        if _out is None:
+            _out = StringIO()
+        self._function(_out, _get_context(_context, context), _blocks)
+        return _out.getvalue()
+
+    def render_to(self, _out, _encoding='utf-8', _chunk_size=CHUNK_SIZE, _context=None,
+                  _blocks=None, **context):
+        """Renders the template into a binary file object. See Tag.render_to().
+
+        Static chunks are encoded once per encoding.
+        """
+        context = _get_context(_context, context)
+        chunks = self._encoded.get(_encoding)
+        if chunks is None:
+            chunks = self._encoded[_encoding] = [
+                _encode(chunk, _encoding) if isinstance(chunk, str) else chunk
+                for chunk in self.chunks]
+
+        data = bytearray()
+        buf = _Buffer()
+        for chunk in chunks:
+            if chunk.__class__ is bytes:
+                data += chunk
+            elif chunk.func is _render_item:
+                # Dynamic content can be large, it is written while it is rendered.
+                renderer = _Renderer(buf, context, blocks=_blocks)
+                for _ in renderer.iterate(*chunk.args, chunk_size=_chunk_size, **chunk.keywords):
+                    data += _encode(buf.pop(), _encoding)
+                    if len(data) >= _chunk_size:
+                        _out.write(bytes(data))
+                        del data[:]
+            else:
+                chunk(buf, context)
+                data += _encode(buf.pop(), _encoding)
+            if len(data) >= _chunk_size:
+                _out.write(bytes(data))
+                del data[:]
+        if data:
+            _out.write(bytes(data))
+
+
+def _generate(chunks):
+    """Returns the source of a function rendering chunks of a Template
+    into a StringIO, its code and the objects it is created with.
+
+    Static text becomes string constants. Lazy attribute values and
+    callables returning text are written inline, other slots are
+    rendered with _render_item. Objects in slots are bound as closure
+    variables.
+    """
+    gen = _CodeGenerator()
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            gen.text(chunk)
+        elif chunk.func is _render_item:
+            owner, item = chunk.args
+            gen.item(owner, item, chunk.keywords['indent'], chunk.keywords['pretty'])
+        else:
+            # Tag._write_attribute bound to the tag.
+            gen.attribute(*chunk.args)
+    return gen.finish()
+
+
+class _CodeGenerator(object):
+
+    def __init__(self):
+        self.lines = []
+        self.names = {}  # type: Dict[str, Any]
+        self.pending = []  # type: List[str]
+
+    def bind(self, value):
+        name = 'v%d' % len(self.names)
+        self.names[name] = value
+        return name
+
+    def text(self, s):
+        self.pending.append(s)
+
+    def flush(self):
+        if self.pending:
+            self.emit('write(%r)' % ''.join(self.pending))
+            self.pending = []
+
+    def emit(self, line):
+        self.lines.append('    ' + line)
+
+    def attribute(self, key, value):
+        key = key.rstrip('_').replace('_', '-')
+        self.text(' %s="' % key)
+        self.flush()
+        if callable(value):
+            self.emit('value = %s(context)' % self.bind(value))
+        else:
+            self.emit('value = %s' % self.bind(value))
+        self.emit('write(escape(value if value.__class__ is str else _text(value)))')
+        self.text('"')
+
+    def item(self, owner, item, indent, pretty):
+        self.flush()
+        args = '%s, %%s, out, context, %d, %r, blocks' % (self.bind(owner), indent, bool(pretty))
+        if not callable(item) or isinstance(item, Tag):
+            self.emit('render_item(%s)' % (args % self.bind(item)))
+            return
+
+        # Callables returning text or numbers are common,
+        # write them without a renderer, same as Tag._write_as_string.
+        pad = ' ' * indent if pretty and not owner.whitespace_sensitive else ''
+        value = 'value' if owner.safe else 'escape(value)'
+        self.emit('value = %s(context)' % self.bind(item))
+        self.emit('cls = value.__class__')
+        self.emit('if cls is str:')
+        if pad:
+            self.emit('    for line in %s.splitlines(True):' % value)
+            self.emit('        write(%r)' % pad)
+            self.emit('        write(line)')
+        else:
+            self.emit('    write(%s)' % value)
+        self.emit('elif cls is int or cls is float:')
+        self.emit('    write(%r + str(value))' % pad)
+        self.emit('else:')
+        self.emit('    render_item(%s)' % (args % 'value'))
+
+    def finish(self):
+        self.flush()
+        lines = ['def make(%s):' % ', '.join(sorted(self.names)),
+                 '    def render(out, context, blocks=None):',
+                 '        write = out.write']
+        lines.extend('    ' + line for line in self.lines)
+        lines.append('    return render\n')
+        source = '\n'.join(lines)
+        return source, compile(source, '<pyhtml template>', 'exec'), self.names
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value
+    return str(value)
+
+
+class TemplateCache(object):
+    """Directory of compiled templates for Tag.compile(cache=...).
+
+    Like .pyc files, entries are keyed by a hash of the structure of the
+    tree and the pyhtml and Python versions. Static markup and the code of
+    the render function are stored, callables are taken from the tree
+    when the template is loaded. Stale or unreadable entries are replaced.
+    Entries are loaded with marshal, the directory must be trusted.
+    """
+
+    suffix = '.pyhtmlc'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, tag, pretty):
+        return os.path.join(self.directory, _fingerprint(tag, pretty) + self.suffix)
+
+    def compile(self, tag, pretty):
+        path = self.path(tag, pretty)
+        try:
+            with open(path, 'rb') as f:
+                # Entries are only read from the trusted cache directory.
+                return _load_template(tag, marshal.load(f))  # nosec B302
+        except (OSError, EOFError, ValueError, TypeError, KeyError, IndexError):
+            pass
+
+        template = tag.compile(pretty)
+        data = _dump_template(tag, template)
+        if data is not None:
+            self._write(path, data)
+        return template
+
+    def _write(self, path, data):
+        # Written to a temporary file first, so that
+        # other processes do not read a partial entry.
+        os.makedirs(self.directory, exist_ok=True)
+        import tempfile
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(data, f)
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+
+# Changed when the generated code of templates changes.
+_CODE_FORMAT = 2
+
+
+def _fingerprint(root, pretty):
+    """Returns a hash of everything that the compiled template of
+    root depends on, except the callables in it."""
+    import hashlib
+    tokens = [__version__, str(_CODE_FORMAT), sys.version, repr(pretty), repr(INDENT)]
+    stack = [root]  # type: List[Any]
+    while stack:
+        item = stack.pop()
+        if item is _END:
+            tokens.append(')')
+        elif isinstance(item, Tag):
+            cls = type(item)
+            tokens.append('%s.%s(%r %r %r %r %r %r %r' % (
+                cls.__module__, cls.__name__, item.name, item.safe, item.sort_attributes,
+                item.self_closing, item.whitespace_sensitive, item.doctype,
+                getattr(item, 'block_name', None)))
+            for key, value in item._attribute_dict().items():
+                tokens.append('%s=%s' % (key, '<lazy>' if _is_lazy(value) else _text(value)))
+            stack.append(_END)
+            stack.extend(reversed(item._children))
+        elif isinstance(item, (list, tuple)):
+            tokens.append('[')
+            stack.append(_END)
+            stack.extend(reversed(item))
+        elif isinstance(item, TagMeta) or _is_static(item):
+            tokens.append('%s:%s' % (type(item).__name__, _text(item)))
+        else:
+            # Evaluated when rendering.
+            tokens.append('<%s>' % type(item).__name__)
+    return hashlib.sha256('\0'.join(tokens).encode('utf-8')).hexdigest()
+
+
+_END = object()
+
+
+def _dump_template(root, template):
+    """Returns template as marshallable data. Objects from the tree are
+    replaced with their paths from root. Returns None if an object
+    cannot be found in the tree."""
+    paths = _object_paths(root)
+    try:
+        chunks = []
+        for chunk in template.chunks:
+            if isinstance(chunk, str):
+                chunks.append(chunk)
+            elif chunk.func is _render_item:
+                owner, item = chunk.args
+                chunks.append(('item', paths[id(owner)], paths[id(item)],
+                               chunk.keywords['indent'], chunk.keywords['pretty']))
+            else:
+                chunks.append(('attribute', paths[id(chunk.func.__self__)], chunk.args[0]))
+        names = {name: paths[id(value)] for name, value in template._names.items()}
+    except KeyError:
+        return None
+    return {'chunks': chunks, 'source': template.source, 'code': template._code, 'names': names}
+
+
+def _load_template(root, data):
+    chunks = []
+    for chunk in data['chunks']:
+        if isinstance(chunk, str):
+            chunks.append(chunk)
+        elif chunk[0] == 'item':
+            _, owner, item, indent, pretty = chunk
+            chunks.append(partial(_render_item, _resolve(root, owner), _resolve(root, item),
+                                  indent=indent, pretty=pretty))
+        else:
+            _, tag, key = chunk
+            tag = _resolve(root, tag)
+            chunks.append(partial(tag._write_attribute, key, tag._attribute_dict()[key]))
+    names = {name: _resolve(root, path) for name, path in data['names'].items()}
+    return Template(chunks, (data['source'], data['code'], names))
+
+
+def _object_paths(root):
+    """Maps ids of tags, sequences and callables in the tree to their paths.
+
+    A path is a tuple of child indexes, or attribute names for values of
+    lazy attributes.
+    """
+    paths = {}  # type: Dict[int, tuple]
+    stack = [(root, ())]  # type: List[Any]
+    while stack:
+        item, path = stack.pop()
+        if isinstance(item, Tag):
+            for key, value in item._attribute_dict().items():
+                if _is_lazy(value):
+                    paths.setdefault(id(value), path + (key,))
+            children = item._children
+        elif isinstance(item, (list, tuple)):
+            children = item
+        elif callable(item) or isinstance(item, GeneratorType):
+            paths.setdefault(id(item), path)
+            continue
+        else:
+            continue
+
+        paths.setdefault(id(item), path)
+        for i, child in enumerate(children):
+            stack.append((child, path + (i,)))
+    return paths
+
+
+def _resolve(root, path):
+    item = root
+    for step in path:
+        if isinstance(step, int):
+            item = (item._children if isinstance(item, Tag) else item)[step]
+        else:
+            item = item._attribute_dict()[step]
+    return item
+
+
+def render_many(template, contexts, workers=None, pretty=None, chunksize=16):
+    """Renders a template with each context and yields the outputs in order.
+
+    template is a Tag, which is compiled once, or a compiled Template.
+    If workers is more than 1, contexts are rendered in that many forked
+    processes. Callables in the template need not be picklable, but
+    contexts and outputs are sent between processes. Contexts are rendered
+    in the calling process if fork is not available on the platform.
+    """
+    if isinstance(template, Tag):
+        template = template.compile(pretty)
+
+    context = _fork_context() if workers and workers > 1 else None
+    if context is None:
+        return (template.render(_context=c) for c in contexts)
+    return _render_forked(context, template, contexts, workers, chunksize)
+
+
+def _fork_context():
+    import multiprocessing
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+def _render_forked(context, template, contexts, workers, chunksize):
+    # Forked workers inherit the template from the initializer
+    # arguments without pickling them.
+    pool = context.Pool(workers, _init_worker, (template,))
+    try:
+        for output in pool.imap(_render_in_worker, contexts, chunksize):
+            yield output
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Template rendered by a worker process of render_many().
+_worker_template = None  # type: Template
+
+
+def _init_worker(template):
+    global _worker_template
+    _worker_template = template
+
+
+def _render_in_worker(context):
+    return _worker_template.render(_context=context)
+
+
+class _Renderer(object):
+    """Renders a tree without recursion by keeping the work to be done
+    on an explicit stack, so the depth of a tree is not limited.
+
+    Items on the stack are strings to be written,
+    (owner, item, indent, pretty) tuples of items to be rendered, and
+    (owner, iterator, indent, pretty, separate) tuples of generators
+    which are consumed one item at a time.
+
+    Owner is the tag whose content is being rendered; its escaping and
+    whitespace rules apply to the item.
+    """
+
+    compiling = False
+    memoize = True
+
+    def __init__(self, out, context, executor=None, blocks=None):
+        self.out = out
+        self.context = context
+        self.executor = executor
+        # Content of blocks given when rendering, by block name.
+        self.blocks = blocks
+        self.stack = []
+
+    def render(self, owner, item, indent, pretty):
+        for _ in self.iterate(owner, item, indent, pretty):
+            pass
+
+    def iterate(self, owner, item, indent, pretty, chunk_size=None):
+        """Renders the item and yields each time at least chunk_size
+        characters have been written to out since the last yield."""
+        out = self.out
+        write = out.write
+        stack = self.stack
+        push = stack.append
+        pop = stack.pop
+
+        push((owner, item, indent, pretty))
+        while stack:
+            if chunk_size is not None and out.tell() >= chunk_size:
+                yield
+
+            task = pop()
+            if task.__class__ is not tuple:
+                write(task)
+                continue
+
+            if len(task) == 5:
+                self._advance(task)
+                continue
+
+            owner, item, indent, pretty = task
+            cls = item.__class__
+            if cls is str or cls is int or cls is float:
+                # Leaves are the most common items.
+                owner._write_as_string(item, out, indent, pretty)
+            elif isinstance(item, Tag):
+                item._expand(self, owner, indent, pretty)
+            else:
+                self._dispatch(owner, item, indent, pretty)
+
+        if chunk_size is not None and out.tell():
+            yield
+
+    def _advance(self, task):
+        # Pushes the next item of a generator, followed by the generator.
+        owner, iterator, indent, pretty, separate = task
+        for child in iterator:
+            self.stack.append((owner, iterator, indent, pretty,
+                               pretty and not owner.whitespace_sensitive))
+            if separate:
+                self.out.write('\n')
+            self.push_child(owner, child, indent, pretty)
+            break
+
+    def push_child(self, owner, child, indent, pretty):
+        # Pushes an item yielded by a generator.
+        self.stack.append((owner, child, indent, pretty))
+
+    def _dispatch(self, owner, item, indent, pretty):
+        # Renders items other than text, numbers and tags.
+        if isinstance(item, TagMeta):
+            owner._write_as_string(item, self.out, indent, pretty, escape=False)
+        elif self.compiling and not _is_static(item):
+            self.slot(owner, item, indent, pretty)
+        elif callable(item):
+            self.stack.append((owner, item(self.context), indent, pretty))
+        elif isinstance(item, GeneratorType):
+            self.stack.append((owner, item, indent, pretty, False))
+        elif isinstance(item, (list, tuple)):
+            self.push_list(owner, item, indent, pretty)
+        elif hasattr(item, '__await__'):
+            _not_awaited(item)
+        else:
+            owner._write_as_string(item, self.out, indent, pretty)
+
+    def push_list(self, owner, l, indent, pretty):
+        if owner._write_text_list(l, self.out, indent, pretty):
+            return
+
+        # Pushed in reverse so that the first child is popped first.
+        separate = pretty and not owner.whitespace_sensitive
+        stack = self.stack
+        for i in range(len(l) - 1, -1, -1):
+            stack.append((owner, l[i], indent, pretty))
+            if i and separate:
+                stack.append('\n')
+
+
+class _Compiler(_Renderer):
+    """Renders static parts of a tree into a _PlanBuilder and
+    records dynamic parts as slots."""
+
+    compiling = True
+    # Static parts are merged into the plan.
+    memoize = False
+
+    def __init__(self, plan):
+        _Renderer.__init__(self, plan, None)
+
+    def slot(self, owner, item, indent, pretty):
+        self.out.slot(partial(_render_item, owner, item,
+                              indent=indent, pretty=pretty))
+
+
+class _ProfilingRenderer(_Renderer):
+    """Renderer which records RenderStats.
+
+    Each tag and callable is pushed between enter and exit markers.
+    Markers are not tuples, so the render loop passes them to out.write()
+    where _ProfilingOutput handles them. The render loop is unchanged and
+    rendering without stats pays nothing for profiling.
+    """
+
+    def __init__(self, out, context, executor, stats, blocks=None):
+        _Renderer.__init__(self, _ProfilingOutput(out, self), context, executor, blocks)
+        self.stats = stats
+        self.timer = _timer
+        self.frames = []  # type: List[list]
+        self.active = {}  # type: Dict[str, int]
+
+    def iterate(self, owner, item, indent, pretty, chunk_size=None):
+        self.stack.append(_Marker(None))
+        self.enter(_node_name(item))
+        return _Renderer.iterate(self, owner, item, indent, pretty, chunk_size)
+
+    def push_list(self, owner, l, indent, pretty):
+        if owner._write_text_list(l, self.out, indent, pretty):
+            return
+
+        separate = pretty and not owner.whitespace_sensitive
+        for i in range(len(l) - 1, -1, -1):
+            self.push_child(owner, l[i], indent, pretty)
+            if i and separate:
+                self.stack.append('\n')
+
+    def push_child(self, owner, child, indent, pretty):
+        name = _node_name(child)
+        if name is None:
+            self.stack.append((owner, child, indent, pretty))
+        else:
+            self.stack.append(_Marker(None))
+            self.stack.append((owner, child, indent, pretty))
+            self.stack.append(_Marker(name))
+
+    def enter(self, name):
+        self.active[name] = self.active.get(name, 0) + 1
+        path = self.frames[-1][0] + (name,) if self.frames else (name,)
+        # path, start time, time in children, bytes at start
+        self.frames.append([path, self.timer(), 0.0, self.out.bytes])
+
+    def exit(self):
+        path, start, children, start_bytes = self.frames.pop()
+        name = path[-1]
+        inclusive = self.timer() - start
+        exclusive = inclusive - children
+        if self.frames:
+            self.frames[-1][2] += inclusive
+
+        stats = self.stats
+        node = stats.nodes.get(name)
+        if node is None:
+            node = stats.nodes[name] = NodeStats()
+        node.calls += 1
+        node.exclusive += exclusive
+        self.active[name] -= 1
+        if not self.active[name]:
+            node.inclusive += inclusive
+            node.bytes += self.out.bytes - start_bytes
+        stats.stacks[path] = stats.stacks.get(path, 0.0) + exclusive
+
+
+class _Marker(object):
+    """Enters the named node when written, or exits the current one if
+    name is None."""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class _ProfilingOutput(object):
+    """Counts written characters and handles markers. Writes go to out."""
+
+    def __init__(self, out, renderer):
+        self.out = out
+        self.renderer = renderer
+        self.bytes = 0
+
+    def write(self, s):
+        if s.__class__ is _Marker:
+            if s.name is None:
+                self.renderer.exit()
+            else:
+                self.renderer.enter(s.name)
+        else:
+            self.bytes += len(s)
+            self.out.write(s)
+
+    def tell(self):
+        return self.out.tell()
+
+
+def _node_name(item):
+    if isinstance(item, Block) and not isinstance(item, Safe):
+        return 'Block(%r)' % item.block_name
+    if isinstance(item, Tag):
+        return item.name
+    if callable(item) and not isinstance(item, TagMeta):
+        name = getattr(item, '__qualname__', None) or getattr(item, '__name__', None)
+        name = name or type(item).__name__
+        # Drop names of enclosing functions.
+        return name.rpartition('<locals>.')[2] + '()'
+    return None
+
+
+_timer = time.perf_counter
+
+
+def _not_awaited(item):
+    if hasattr(item, 'close'):
+        # Otherwise Python warns that the coroutine was never awaited.
+        item.close()
+    raise TypeError('%r cannot be rendered here, coroutines are only awaited by '
+                    'render_async() and aiter_render(), and not in ForEach or Rows' % item)
+
+
+def _render_item(owner, item, out, context, indent, pretty, blocks=None):
+    _Renderer(out, context, blocks=blocks).render(owner, item, indent, pretty)
+
+
+def _is_static(item):
+    # Callables, generators and arbitrary objects are
+    # evaluated when a compiled template is rendered.
+    return item is None or isinstance(item, (str, list, tuple, Number))
+
+
+def _encode(text, encoding):
+    if encoding is None:
+        return text
+    return text.encode(encoding, 'xmlcharrefreplace')
+
+
+class _Buffer(StringIO):
+    """Output stream which can be emptied after reading its contents."""
+
+    def __init__(self):
+        StringIO.__init__(self)
+
+    def pop(self):
+        s = self.getvalue()
+        self.seek(0)
+        self.truncate()
+        return s
+
+
+# Owner of output which is written as it is.
+_RAW = Safe()
+
+
+class _PlanBuilder(_Buffer):
+    """Output stream which collects static writes between slots."""
+
+    def __init__(self):
+        _Buffer.__init__(self)
+        self._chunks = []
+
+    def slot(self, fn):
+        self._flush()
+        self._chunks.append(fn)
+
+    def chunks(self):
+        self._flush()
+        return self._chunks
+
+    def _flush(self):
+        s = self.pop()
+        if s:
+            self._chunks.append(s)
+
 
 def Var(var, default=None):
     """Helper function for printing a variable from context."""
@@ -482,42 +2506,71 @@ def Var(var, default=None):
 
 
 class SelfClosingTag(Tag):
+    __slots__ = ()
     self_closing = True
 
 
 class WhitespaceSensitiveTag(Tag):
+    __slots__ = ()
     whitespace_sensitive = True
 
 
 class html(Tag):
+    __slots__ = ()
     doctype = '<!DOCTYPE html>'
 
 
 class script(Tag):
+    __slots__ = ()
     safe = True
     default_attributes = {'type': 'text/javascript'}
 
 
 class style(Tag):
+    __slots__ = ()
     default_attributes = {'type': 'text/css'}
 
 
 class form(Tag):
+    __slots__ = ()
     default_attributes = {'method': 'POST'}
 
 
 class input_(SelfClosingTag):
+    __slots__ = ()
     name = 'input'
     default_attributes_if_defined = {'formaction': {'formmethod': 'POST'}}
 
 
 _M = sys.modules[__name__]
 
+# Parent classes of registered tags by name.
+_tag_parents = {}  # type: Dict[str, type]
+
 
 def register_all(tags, parent):
     for tag in tags.split():
         __all__.append(tag)
-        setattr(_M, tag, type(tag, (parent, ), {'name': tag.rstrip('_')}))
+        _tag_parents[tag] = parent
+        if sys.version_info < (3, 7):
+            # Module __getattr__ is not supported.
+            _make_tag(tag)
+
+
+def _make_tag(tag):
+    cls = type(tag, (_tag_parents[tag], ), {'name': tag.rstrip('_'), '__slots__': ()})
+    # Another thread may have created the class first.
+    return _M.__dict__.setdefault(tag, cls)
+
+
+def __getattr__(name):
+    if name in _tag_parents:
+        return _make_tag(name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_tag_parents))
 
 
 register_all(tags, Tag)
@@ -527,4 +2580,4 @@ register_all(whitespace_sensitive_tags, WhitespaceSensitiveTag)
 
 if __name__ == "__main__":
     import doctest
-    doctest.testmod(extraglobs={'print_function': print_function})  # type: ignore
+    doctest.testmod()
@@ -0,0 +1,246 @@
+"""
+Asynchronous rendering for PyHTML. Requires Python 3.6 or newer.
+
+This module is used by Tag.render_async() and Tag.aiter_render().
+
+Children and attribute values may be coroutine functions, awaitables or
+async generators in addition to everything render() accepts. Coroutine
+functions found in the tree are started before any output is written, so
+slow fragments of a page are awaited concurrently. Their results are written
+in document order.
+"""
+
+import asyncio
+import inspect
+from types import GeneratorType
+
+import pyhtml
+from pyhtml import INDENT, Tag, TagMeta, _Buffer
+
+
+async def render_async(tag, context, pretty=None, blocks=None):
+    out = _Buffer()
+    async for _ in _stream(tag, out, context, pretty, blocks):
+        pass
+    return out.getvalue()
+
+
+async def aiter_render(tag, context, chunk_size, pretty=None, blocks=None):
+    out = _Buffer()
+    async for _ in _stream(tag, out, context, pretty, blocks):
+        if out.tell() >= chunk_size:
+            yield out.pop()
+
+    rest = out.pop()
+    if rest:
+        yield rest
+
+
+async def _stream(tag, out, context, pretty, blocks):
+    if pretty is None:
+        pretty = pyhtml.PRETTY
+
+    renderer = _AsyncRenderer(out, context, blocks)
+    try:
+        renderer.prefetch(tag)
+        async for _ in renderer.stream_item(tag, tag, 0, pretty, None):
+            yield
+    finally:
+        renderer.cancel()
+
+
+def _is_async(value):
+    return inspect.iscoroutinefunction(value) or inspect.isawaitable(value)
+
+
+class _AsyncRenderer(object):
+
+    def __init__(self, out, context, blocks=None):
+        self.out = out
+        self.context = context
+        # Content of blocks given when rendering, by block name.
+        self.blocks = blocks
+        # Started tasks by position in the tree.
+        # Position is (id(container), index) or (id(tag), attribute name).
+        self.tasks = {}
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+    def prefetch(self, item):
+        """Starts coroutines found in the static part of the tree."""
+        if isinstance(item, Tag):
+            item._prefetch(self)
+        elif isinstance(item, (list, tuple)):
+            self._prefetch_list(item)
+
+    def prefetch_tag(self, tag):
+        for part in tag._serialized_attributes():
+            if isinstance(part, tuple) and _is_async(part[1]):
+                self._start((id(tag), part[0]), part[1])
+        self._prefetch_list(tag._children)
+
+    def prefetch_block(self, block):
+        content = self._block_content(block)
+        if content is None:
+            self.prefetch_tag(block)
+        elif _is_async(content):
+            self._start((id(block), None), content)
+        else:
+            self.prefetch(content)
+
+    def _prefetch_list(self, l):
+        for i, child in enumerate(l):
+            if _is_async(child):
+                self._start((id(l), i), child)
+            else:
+                self.prefetch(child)
+
+    def _block_content(self, block):
+        # Returns content given for the block when rendering, if any.
+        if self.blocks is not None and block.block_name in self.blocks:
+            return self.blocks[block.block_name]
+        return None
+
+    def _start(self, position, value):
+        if callable(value):
+            value = value(self.context)
+        self.tasks[position] = asyncio.ensure_future(value)
+
+    async def _evaluate(self, position, value):
+        task = self.tasks.pop(position, None)
+        if task is not None:
+            return await task
+
+        if callable(value):
+            value = value(self.context)
+        if inspect.isawaitable(value):
+            value = await value
+        return value
+
+    async def stream_item(self, owner, item, indent, pretty, position):
+        if isinstance(item, Tag):
+            async for _ in item._expand_async(self, owner, indent, pretty):
+                yield
+        elif isinstance(item, TagMeta):
+            owner._write_as_string(item, self.out, indent, pretty, escape=False)
+        elif callable(item) or inspect.isawaitable(item):
+            rv = await self._evaluate(position, item)
+            self.prefetch(rv)
+            async for _ in self.stream_item(owner, rv, indent, pretty, None):
+                yield
+        elif inspect.isasyncgen(item):
+            async for _ in self.stream_async_list(owner, item, indent,
+                                                  pretty):
+                yield
+        elif isinstance(item, (GeneratorType, list, tuple)):
+            async for _ in self.stream_list(owner, item, indent, pretty):
+                yield
+        else:
+            owner._write_as_string(item, self.out, indent, pretty)
+
+    async def stream_tag(self, tag, indent, pretty):
+        if tag._static is not False:
+            output = tag._static_output(indent, pretty)
+            if output is not None:
+                self.out.write(output)
+                return
+
+        parts = []
+        for part in tag._serialized_attributes():
+            if isinstance(part, tuple):
+                key, value = part
+                value = await self._evaluate((id(tag), key), value)
+                part = (key, value)
+            parts.append(part)
+
+        tag._begin_start_tag(self.out, indent, pretty)
+        for part in parts:
+            if isinstance(part, tuple):
+                tag._write_attribute(part[0], part[1], self.out, self.context)
+            else:
+                self.out.write(part)
+        tag._end_start_tag(self.out, pretty)
+
+        if tag._children and not tag.self_closing:
+            async for _ in self.stream_list(tag, tag._children,
+                                            indent + INDENT,
+                                            tag._inner_pretty(pretty)):
+                yield
+
+        tag._write_end_tag(self.out, indent, pretty)
+        yield
+
+    async def stream_cached(self, cached, indent, pretty):
+        blocks = cached._blocks_below()
+        texts = []
+        for block in blocks:
+            async for _ in self.stream_captured(block, block, 0, pretty, texts):
+                yield
+        key = cached._cache_key(
+            self.context, indent, pretty,
+            [(block.block_name, text) for block, text in zip(blocks, texts)])
+        value = cached._lookup(key)
+        if value is None:
+            self._prefetch_list(cached._children)
+            outputs = []
+            async for _ in self.stream_captured(cached, cached._children,
+                                                indent, pretty, outputs):
+                yield
+            value = outputs[0]
+            cached.cache.set(key, value, cached.ttl)
+        self.out.write(value)
+
+    async def stream_captured(self, owner, item, indent, pretty, outputs):
+        # Renders item into a separate buffer and appends the output to outputs.
+        out, self.out = self.out, _Buffer()
+        try:
+            async for _ in self.stream_item(owner, item, indent, pretty, None):
+                yield
+            outputs.append(self.out.getvalue())
+        finally:
+            self.out = out
+
+    async def stream_block(self, block, indent, pretty):
+        content = self._block_content(block)
+        if content is None:
+            items, position = block._children, None
+        else:
+            items, position = content, (id(block), None)
+        async for _ in self.stream_item(block, items, indent, pretty, position):
+            yield
+
+    async def stream_batches(self, batches):
+        for batch in batches:
+            self.out.write(batch)
+            yield
+
+    async def stream_list(self, owner, l, indent, pretty):
+        lazy = isinstance(l, GeneratorType)
+        for i, child in enumerate(l):
+            if i != 0 and pretty and not owner.whitespace_sensitive:
+                self.out.write('\n')
+
+            if lazy:
+                self.prefetch(child)
+
+            position = (id(l), i)
+            async for _ in self.stream_item(owner, child, indent, pretty,
+                                            position):
+                yield
+            yield
+
+    async def stream_async_list(self, owner, l, indent, pretty):
+        i = 0
+        async for child in l:
+            if i != 0 and pretty and not owner.whitespace_sensitive:
+                self.out.write('\n')
+            i += 1
+
+            self.prefetch(child)
+
+            async for _ in self.stream_item(owner, child, indent, pretty,
+                                            None):
+                yield
+            yield
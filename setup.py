@@ -25,8 +25,8 @@ setup(
     author_email='cenkalti@gmail.com',
     keywords='html template markup',
     url='https://github.com/cenkalti/pyhtml',
-    py_modules=['pyhtml'],
-    install_requires=['six'],
+    py_modules=['pyhtml', 'pyhtml_async'],
+    python_requires='>=3.6',
     zip_safe=False,
     include_package_data=True,
     test_suite='tests',
@@ -38,8 +38,8 @@ setup(
         'License :: OSI Approved :: Apache Software License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
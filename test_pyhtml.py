@@ -1,9 +1,19 @@
 # -*- coding: utf8 -*-
+import io
+import operator
+import os
+import pickle  # nosec B403
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
-
-import six
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from types import GeneratorType
 
 from pyhtml import *
+from pyhtml import _escape, _escape_all
 
 
 class TestPyHTML(unittest.TestCase):
@@ -13,7 +23,7 @@ class TestPyHTML(unittest.TestCase):
     def assertEqual(self, first, second, msg=None):
         """Overridden for ignoring whitespace."""
         def remove_whitespace(s):
-            if isinstance(s, six.string_types):
+            if isinstance(s, str):
                 return s.replace(' ', '').replace('\n', '')
             else:
                 return s
@@ -199,6 +209,58 @@ class TestPyHTML(unittest.TestCase):
         self.assertEqual(str(t), '<div></div>')
         self.assertEqual(str(t2), '<div>1</div>')
 
+    def test_copy_shares_static_subtrees(self):
+        nav = ul(li('a'), li('b'))
+        t = html(head(title('x')), body(nav, div(Block('main')), Block('footer')))
+        t2 = t.copy()
+        self.assertIs(t2._children[0], t._children[0])
+        self.assertIs(t2._children[1]._children[0], nav)
+        self.assertIsNot(t2._children[1], t._children[1])
+        self.assertIsNot(t2.blocks['main'][0], t.blocks['main'][0])
+
+        t2['main'] = 'm'
+        t2['footer'] = 'f'
+        self.assertIn('<div>m</div>f</body>', t2.render(_pretty=False))
+        self.assertIn('<div></div></body>', t.render(_pretty=False))
+
+    def test_copy_on_write(self):
+        nav = ul(li('a'), li('b'))
+        layout = html(body(nav, Block('main')))
+        t2 = layout.copy()
+        t2.children[0].children[0].children[1]('CHANGED')
+        layout.children[0].children[0].attributes['class'] = 'nav'
+        self.assertEqual(layout.render(_pretty=False),
+                         '<!DOCTYPE html>\n<html><body><ul class="nav"><li>a</li><li>b</li>'
+                         '</ul></body></html>')
+        self.assertEqual(t2.render(_pretty=False),
+                         '<!DOCTYPE html>\n<html><body><ul><li>a</li><li>CHANGED</li>'
+                         '</ul></body></html>')
+        # Writes to shared tags which are not made through children raise.
+        with self.assertRaises(TypeError):
+            nav.children[0]('x')
+        with self.assertRaises(TypeError):
+            nav.attributes['id'] = 'x'
+
+    def test_copy_attributes(self):
+        t = div(id='a')(Block('b'))
+        t2 = t.copy()
+        t2.attributes['id'] = 'b'
+        self.assertEqual(str(t), '<div id="a"></div>')
+        self.assertEqual(str(t2), '<div id="b"></div>')
+
+    def test_copy_subclass(self):
+        class card(div):
+            def __init__(self, *args, **kwargs):
+                div.__init__(self, *args, **kwargs)
+                self.title = 'x'
+        t = card(class_='c')(Block('b'))
+        t2 = t.copy()
+        t2['b'] = 'b'
+        self.assertIsInstance(t2, card)
+        self.assertEqual(t2.title, 'x')
+        self.assertEqual(str(t2), '<div class="c">b</div>')
+        self.assertEqual(str(t), '<div class="c"></div>')
+
     def test_escape_tag(self):
         dangerous = '<script>'
         tag = div(dangerous)
@@ -211,11 +273,71 @@ class TestPyHTML(unittest.TestCase):
         rendered = str(tag)
         self.assertEqual(rendered, '<div>&lt;script&gt;</div>')
 
+    def test_escape(self):
+        self.assertEqualWS(_escape(''), '')
+        self.assertEqualWS(_escape('clean text'), 'clean text')
+        self.assertEqualWS(_escape('<a href="x">\'&amp;\'</a>'),
+                           '&lt;a href=&quot;x&quot;&gt;&#x27;&amp;amp;&#x27;&lt;/a&gt;')
+
+    def test_escape_all(self):
+        texts = ['a', '<b>', '', 'c & d', '"']
+        self.assertEqualWS(_escape_all(texts), [_escape(t) for t in texts])
+        texts = ['a\0<', '>']
+        self.assertEqualWS(_escape_all(texts), [_escape(t) for t in texts])
+
+    def test_escape_list(self):
+        l = lambda ctx: [u'<a>', u'b', u'c\nd']
+        self.assertEqualWS(str(div(l)), '<div>\n  &lt;a&gt;\n  b\n  c\n  d\n</div>')
+
     def test_block_safe(self):
         x = div('<script>')
         x.safe = True
         self.assertTrue('<script>' in str(x))
 
+    def test_slots(self):
+        for tag in (div(), hr(), pre(), html(), form(), Block('b'), Safe('x')):
+            self.assertFalse(hasattr(tag, '__dict__'), tag)
+
+    def test_pickle(self):
+        t = div(id='x')(p(class_='a')('a'), Block('b'), hr)
+        t.render()
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            # Only tags pickled by the test are loaded.
+            t2 = pickle.loads(pickle.dumps(t, protocol))  # nosec B301
+            self.assertEqual(t2.render(), t.render())
+            t2.attributes['id'] = 'y'
+            t2['b'] = 'b'
+            self.assertEqual(t2.render(_pretty=False),
+                             '<div id="y"><p class="a">a</p>b<hr/></div>')
+
+        t3 = pickle.loads(pickle.dumps(t.freeze()))  # nosec B301
+        self.assertRaises(TypeError, t3.children[0].attributes.update, {'class': 'b'})
+
+    def test_lazy_tag_classes(self):
+        import pyhtml
+        self.assertIs(pyhtml.td, td)
+        self.assertIs(pyhtml.kbd, kbd)
+        self.assertTrue(issubclass(pyhtml.br, SelfClosingTag))
+        self.assertIsInstance(pyhtml.dfn(), Tag)
+        self.assertIn('caption', dir(pyhtml))
+        self.assertRaises(AttributeError, getattr, pyhtml, 'blink')
+
+    def test_shared_default_attributes(self):
+        f1, f2 = form(), form()
+        f1.attributes['action'] = '/x'
+        self.assertEqual(str(f1), '<form action="/x" method="POST"></form>')
+        self.assertEqual(str(f2), '<form method="POST"></form>')
+        self.assertEqual(repr(f2), "form(method='POST')")
+
+    def test_instance_options(self):
+        s = script('<x>')
+        self.assertTrue(script.safe)
+        s.safe = False
+        self.assertEqual(str(s), '<script type="text/javascript">&lt;x&gt;</script>')
+        self.assertEqual(str(script('<x>')), '<script type="text/javascript"><x></script>')
+        self.assertFalse(div.safe)
+        self.assertTrue(div(_safe=True).safe)
+
     def test_safe_in_attr(self):
         x = div(_safe=True)('<script>')
         self.assertTrue('<script>' in str(x))
@@ -254,6 +376,27 @@ class TestPyHTML(unittest.TestCase):
         rendered = tag.render(name='Cenk')
         self.assertEqual(rendered, '<div>Hello Cenk</div>')
 
+    def test_context_mapping(self):
+        class Lazy(Mapping):
+            def __getitem__(self, key):
+                return key.upper()
+
+            def __iter__(self):
+                raise AssertionError('must not be copied')
+
+            def __len__(self):
+                raise AssertionError('must not be copied')
+        ctx = Lazy()
+        seen = []
+        tag = div(title=Var('title'))(p(lambda c: seen.append(c)),
+                                      Block('b')(Var('name')))
+        rendered = tag.render(_context=ctx)
+        self.assertEqual(rendered, '<div title="TITLE"><p></p>NAME</div>')
+        self.assertTrue(seen[0] is ctx)
+        self.assertEqual(''.join(tag.iter_render(_context=ctx)), rendered)
+        self.assertEqual(tag.compile().render(_context=ctx), rendered)
+        self.assertRaises(TypeError, tag.render, _context=ctx, name='x')
+
     def test_context_in_block(self):
         def greet_user(ctx):
             name = ctx.get('name', 'user')
@@ -270,25 +413,45 @@ class TestPyHTML(unittest.TestCase):
         t = title(u'Türkçe')
         rendered = t.render()
         expected = u'<title>Türkçe</title>'
-        self.assertIsInstance(rendered, six.text_type)
+        self.assertIsInstance(rendered, str)
         self.assertEqual(rendered, expected)
 
     def test_unicode_attr_value(self):
         t = title(a=u'Türkçe')
         rendered = t.render()
         expected = u'<title a="Türkçe"></title>'
-        self.assertIsInstance(rendered, six.text_type)
+        self.assertIsInstance(rendered, str)
         self.assertEqual(rendered, expected)
 
     def test_unicode_conversion(self):
-        # calling unicode(tag) on a tag with non-ascii content doesn't result
-        # in a UnicodeDecodeError. It directly renders unicode without encoding
-        # the string in the process.
         t = title(a=u'Türkçe')(u'Türkçe')
-        rendered = six.text_type(t)
+        rendered = str(t)
         expected = u'<title a="Türkçe">Türkçe</title>'
         self.assertEqual(rendered, expected)
 
+    def test_numbers(self):
+        class Weird(int):
+            def __str__(self):
+                return '<1>'
+        t = div(1, 2.5, True, Weird(1), td(3))
+        self.assertEqual(t.render(), '<div>12.5True&lt;1&gt;<td>3</td></div>')
+        self.assertEqual(t.compile().render(), t.render())
+
+    def test_render_to_text_stream(self):
+        class Stream(object):
+            def __init__(self):
+                self.parts = []
+
+            def write(self, s):
+                assert isinstance(s, str)
+                self.parts.append(s)
+
+            def getvalue(self):
+                return ''.join(self.parts)
+        t = div(id=Var('x'))(p(u'Türkçe'), lambda ctx: ctx['x'])
+        self.assertEqualWS(t.render(_out=Stream(), x=1), t.render(x=1))
+        self.assertEqualWS(t.compile().render(_out=Stream(), x=1), t.render(x=1))
+
     def test_self_closing_tag_init(self):
         t = hr(id=3)
         self.assertEqualWS(str(t), '<hr id="3"/>')
@@ -351,6 +514,555 @@ qwerty</pre>
   </body>
 </html>""")
 
+    def test_compact(self):
+        t = html(
+            head(title('title')),
+            body(
+                'text\nwith newlines',
+                Block('b')(p('a'), 'b'),
+                hr,
+                div(pre('asdf\n  zxcv', b('x'))),
+                lambda ctx: [u'c', u'd'],
+            )
+        )
+        expected = ('<!DOCTYPE html><html><head><title>title</title></head>'
+                    '<body>text\nwith newlines<p>a</p>b<hr/><div><pre>asdf\n  zxcv'
+                    '        <b>\n          x\n        </b></pre></div>cd</body></html>')
+        self.assertEqualWS(t.render(_pretty=False), expected)
+        self.assertEqualWS(''.join(t.iter_render(_pretty=False)), expected)
+        self.assertEqualWS(t.compile(pretty=False).render(), expected)
+
+    def test_compact_whitespace_sensitive(self):
+        t = pre('a\n b', b('x'), 'c')
+        self.assertEqualWS(t.render(_pretty=False), t.render())
+
+    def test_compact_default(self):
+        import pyhtml
+        pyhtml.PRETTY = False
+        try:
+            self.assertEqualWS(str(div(p('a'))), '<div><p>a</p></div>')
+        finally:
+            pyhtml.PRETTY = True
+        self.assertEqualWS(str(div(p('a'))), '<div>\n  <p>\n    a\n  </p>\n</div>')
+
+    def test_deep_tree(self):
+        depth = 10000
+        t = p('x')
+        for _ in range(depth):
+            t = div(t)
+        lines = ['%s<div>' % (' ' * 2 * i) for i in range(depth)]
+        lines += ['%s<p>' % (' ' * 2 * depth), '%sx' % (' ' * 2 * (depth + 1)),
+                  '%s</p>' % (' ' * 2 * depth)]
+        lines += ['%s</div>' % (' ' * 2 * i) for i in reversed(range(depth))]
+        expected = '\n'.join(lines)
+        self.assertEqualWS(t.render(), expected)
+        compact = '<div>' * depth + '<p>x</p>' + '</div>' * depth
+        self.assertEqualWS(t.render(_pretty=False), compact)
+        self.assertEqualWS(''.join(t.iter_render(_pretty=False)), compact)
+        self.assertEqualWS(t.compile(pretty=False).render(), compact)
+
+    def test_cached(self):
+        calls = []
+
+        def nav(ctx):
+            calls.append(ctx['role'])
+            return a(ctx['role'])
+        cached = Cached(nav, key='role')
+        t = div(cached)
+        self.assertEqual(t.render(role='admin', _pretty=False), '<div><a>admin</a></div>')
+        self.assertEqual(t.render(role='admin', _pretty=False), '<div><a>admin</a></div>')
+        self.assertEqual(t.render(role='user', _pretty=False), '<div><a>user</a></div>')
+        self.assertEqual(calls, ['admin', 'user'])
+        self.assertEqual((cached.hits, cached.misses), (1, 2))
+
+        # Output is cached per indentation.
+        self.assertEqual(t.render(role='admin'), div(a('admin')).render())
+        self.assertEqual(section(t).render(role='admin'), section(div(a('admin'))).render())
+        self.assertEqual(section(t).compile().render(role='admin'),
+                         section(div(a('admin'))).render())
+        self.assertEqual(''.join(t.iter_render(role='admin')), div(a('admin')).render())
+        self.assertEqual(calls, ['admin', 'user', 'admin', 'admin'])
+
+    def test_cached_key(self):
+        t = Cached(lambda ctx: ctx['a'] + ctx['b'], key=('a', 'b'))
+        self.assertEqual(t.render(a='1', b='2'), '12')
+        self.assertEqual(t.render(a='1', b='3'), '13')
+        t = Cached(lambda ctx: ctx['a'], key=lambda ctx: ctx['a'][0])
+        self.assertEqual(t.render(a='xy'), 'xy')
+        self.assertEqual(t.render(a='xz'), 'xy')
+        t = Cached(Var('a'))
+        self.assertEqual(t.render(a='x'), 'x')
+        self.assertEqual(t.render(a='y'), 'x')
+
+    def test_cached_ttl(self):
+        now = [0]
+        cache = LRUCache(timer=lambda: now[0])
+        t = Cached(Var('a'), ttl=10, cache=cache)
+        self.assertEqual(t.render(a='x'), 'x')
+        now[0] = 9
+        self.assertEqual(t.render(a='y'), 'x')
+        now[0] = 10
+        self.assertEqual(t.render(a='y'), 'y')
+        self.assertEqual((t.hits, t.misses), (1, 2))
+
+    def test_cached_blocks(self):
+        cached = Cached(p(Block('x')('default')))
+        t = div(cached).freeze()
+        self.assertEqual(t.render(_pretty=False), '<div><p>default</p></div>')
+        self.assertEqual(t.render(_pretty=False, _blocks={'x': 'one'}), '<div><p>one</p></div>')
+        self.assertEqual(t.render(_pretty=False, _blocks={'x': Var('y')}, y='two'),
+                         '<div><p>two</p></div>')
+        self.assertEqual(t.render(_pretty=False, _blocks={'x': 'one'}), '<div><p>one</p></div>')
+        self.assertEqual((cached.hits, cached.misses), (1, 3))
+        # Blocks which are not below the node do not change the entry.
+        self.assertEqual(t.render(_pretty=False, _blocks={'y': 'one'}),
+                         '<div><p>default</p></div>')
+        self.assertEqual((cached.hits, cached.misses), (2, 3))
+
+        layout = div(Cached(p(Block('x')), key='k'))
+        c1 = layout.copy()
+        c1['x'] = 'one'
+        c2 = layout.copy()
+        c2['x'] = 'two'
+        self.assertEqual(c1.render(k=1, _pretty=False), '<div><p>one</p></div>')
+        self.assertEqual(c2.render(k=1, _pretty=False), '<div><p>two</p></div>')
+        self.assertEqual(c1.render(k=1, _pretty=False), '<div><p>one</p></div>')
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', '1')
+        cache.set('b', '2')
+        self.assertEqual(cache.get('a'), '1')
+        cache.set('c', '3')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), '1')
+        self.assertEqual(cache.get('c'), '3')
+        self.assertEqual(len(cache), 2)
+
+    def test_shared_cache(self):
+        store = {}
+        now = [0]
+        timer = lambda: now[0]
+        t1 = Cached(Var('a'), key='k', ttl=5, cache=SharedCache('nav', store, timer=timer))
+        t2 = Cached(Var('a'), key='k', ttl=5, cache=SharedCache('nav', store, timer=timer))
+        self.assertEqual(t1.render(a='x', k=1), 'x')
+        self.assertEqual(t2.render(a='y', k=1), 'x')
+        self.assertEqual(list(store), ["nav:(1, 0, True)"])
+        now[0] = 5
+        self.assertEqual(t2.render(a='y', k=1), 'y')
+
+    def test_parallel(self):
+        def slow(name):
+            def render(ctx):
+                return div(class_=name)(name, ctx['user'], [p(i) for i in range(3)])
+            return render
+
+        t = html(body(
+            header('<h>'),
+            Parallel(slow('sidebar'), 'text', slow('comments'), slow('related'),
+                     Parallel(slow('nested'))),
+            footer(Parallel(i for i in ())),
+        ))
+        with ThreadPoolExecutor(4) as executor:
+            parallel = t.render(_executor=executor, user='<u>')
+            self.assertEqual(t.render(_executor=executor, _pretty=False, user='<u>'),
+                             t.render(_pretty=False, user='<u>'))
+            self.assertEqual(''.join(t.iter_render(_executor=executor, user='<u>')), parallel)
+        self.assertEqual(parallel, t.render(user='<u>'))
+
+    @unittest.skipIf(not hasattr(threading, 'Barrier'), 'requires Python 3.2')
+    def test_parallel_is_concurrent(self):
+        barrier = threading.Barrier(3)
+
+        def meet(ctx):
+            # Would time out if siblings ran one after another.
+            barrier.wait(1)
+            return 'x'
+
+        t = div(Parallel(meet, meet, meet))
+        with ThreadPoolExecutor(3) as executor:
+            self.assertEqual(t.render(_executor=executor, _pretty=False), '<div>xxx</div>')
+
+    def test_parallel_error(self):
+        def fail(ctx):
+            raise ValueError('x')
+        with ThreadPoolExecutor(2) as executor:
+            self.assertRaises(ValueError, div(Parallel('a', fail)).render, _executor=executor)
+
+    def test_rows(self):
+        data = [dict(a=1, b='<b>', c=None), dict(a=2.5, b='x\ny', c=''),
+                dict(a=True, b=u'ç', c=' ')]
+        expected = table(lambda ctx: (tr(td(value) for value in row.values())
+                                      for row in ctx['data']))
+        t = table(Rows('data'))
+        for pretty in (True, False):
+            output = expected.render(data=data, _pretty=pretty)
+            self.assertEqualWS(t.render(data=data, _pretty=pretty), output)
+            self.assertEqualWS(t.compile(pretty).render(data=data), output)
+        self.assertEqualWS(t.render(data=[]), expected.render(data=[]))
+
+        chunks = list(div(p('x'), t, p('y')).iter_render(_chunk_size=1, data=data * 100))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqualWS(''.join(chunks),
+                           div(p('x'), expected, p('y')).render(data=data * 100))
+
+    def test_rows_batches(self):
+        data = [(i, str(i)) for i in range(250)]
+        expected = tbody([tr(td(a), td(b)) for a, b in data])
+        self.assertEqualWS(tbody(Rows(data)).render(), expected.render())
+        self.assertEqualWS(tbody(Rows(iter(data))).render(_pretty=False),
+                           expected.render(_pretty=False))
+
+    def test_rows_whitespace_sensitive(self):
+        data = [(i, str(i)) for i in range(150)]
+        expected = pre([tr(td(a), td(b)) for a, b in data])
+        self.assertEqualWS(pre(Rows(data)).render(), expected.render())
+        self.assertEqualWS(pre(Rows(data)).compile().render(), expected.render())
+
+    def test_rows_columns(self):
+        data = [dict(name='a', price=1.5, id=1), dict(name='<b>', price=2, id=2)]
+        formatters = {'price': lambda v: '%.2f' % v}
+        t = table(Rows(lambda ctx: data, columns=['id', 'price'], formatters=formatters))
+        self.assertEqual(t.render(_pretty=False),
+                         '<table><tr><td>1</td><td>1.50</td></tr>'
+                         '<tr><td>2</td><td>2.00</td></tr></table>')
+        t = table(Rows([('a', 1), ('b', 2)], formatters={1: lambda v: '<%d>' % v}))
+        self.assertEqual(t.render(_pretty=False),
+                         '<table><tr><td>a</td><td>&lt;1&gt;</td></tr>'
+                         '<tr><td>b</td><td>&lt;2&gt;</td></tr></table>')
+
+    def test_for_each(self):
+        links = [('/a', 'A'), ('/b', '<B>')]
+        item = li(a(href=lambda ctx: ctx['link'][0])(lambda ctx: ctx['link'][1]), Var('x'))
+        t = div(ul(class_='nav')(ForEach('links', item, as_='link')), p('end'))
+        expected = div(ul(class_='nav')(
+            lambda ctx: (li(a(href=h)(c), ctx['x']) for h, c in ctx['links'])), p('end'))
+        for pretty in (True, False):
+            self.assertEqualWS(t.render(links=links, x=1, _pretty=pretty),
+                               expected.render(links=links, x=1, _pretty=pretty))
+            self.assertEqualWS(t.compile(pretty).render(links=links, x=1),
+                               expected.render(links=links, x=1, _pretty=pretty))
+        self.assertEqualWS(t.render(links=[], x=1), expected.render(links=[], x=1))
+
+        chunks = list(t.iter_render(_chunk_size=1, links=links * 5000, x=1))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqualWS(''.join(chunks), expected.render(links=links * 5000, x=1))
+
+    def test_for_each_context(self):
+        contexts = []
+
+        def cell(ctx):
+            contexts.append(dict(ctx))
+            return '%s%s%s' % (ctx['x'], ctx.get('i'), ctx['j'])
+        inner = ForEach(lambda ctx: 'ab', span(cell, Var('y', '-')), as_='j')
+        t = ForEach(lambda ctx: range(2), div(inner), as_='i')
+        self.assertEqual(t.render(_pretty=False, x='x'),
+                         '<div><span>x0a-</span><span>x0b-</span></div>'
+                         '<div><span>x1a-</span><span>x1b-</span></div>')
+        # Items are set in the context of the item, not in the parent context.
+        self.assertEqual(contexts[0], {'j': 'a'})
+
+    def test_for_each_blocks(self):
+        t = ul(ForEach('items', li(Block('item'))))
+        t2 = t.copy()
+        t['item'] = Var('item')
+        t2['item'] = lambda ctx: ctx['item'] * 2
+        self.assertEqual(t.render(items=[1, 2], _pretty=False), '<ul><li>1</li><li>2</li></ul>')
+        self.assertEqual(t2.render(items=[1, 2], _pretty=False), '<ul><li>2</li><li>4</li></ul>')
+
+    def test_for_each_parent(self):
+        xs = ['<a>', 'b']
+        for template, item in ((b(Var('item')), b), (Var('item'), lambda x: x)):
+            for parent in (pre, lambda *children: div(*children, _safe=True)):
+                t = parent(ForEach('xs', template))
+                expected = parent(lambda ctx, item=item: [item(x) for x in ctx['xs']])
+                self.assertEqualWS(t.render(xs=xs), expected.render(xs=xs))
+                self.assertEqualWS(t.render(xs=xs, _pretty=False),
+                                   expected.render(xs=xs, _pretty=False))
+
+    def test_for_each_numbers(self):
+        import pyhtml
+        calls = []
+        render_item = pyhtml._render_item
+        pyhtml._render_item = lambda *args: calls.append(args) or render_item(*args)
+        try:
+            t = ul(ForEach('xs', li(Var('item'), Var('x'))))
+            expected = ul(lambda ctx: [li(x, ctx['x']) for x in ctx['xs']])
+            for pretty in (True, False):
+                self.assertEqualWS(t.render(xs=[1, 2.5], x=3, _pretty=pretty),
+                                   expected.render(xs=[1, 2.5], x=3, _pretty=pretty))
+        finally:
+            pyhtml._render_item = render_item
+        # Numbers are written by the template without rendering them.
+        self.assertEqual(calls, [])
+
+    def test_for_each_changed(self):
+        item = li(Var('item'))
+        t = ul(ForEach('items', item))
+        self.assertEqual(t.render(items=[1], _pretty=False), '<ul><li>1</li></ul>')
+        item(Var('item'), '!')
+        self.assertEqual(t.render(items=[1], _pretty=False), '<ul><li>1!</li></ul>')
+        item.attributes['class'] = 'c'
+        self.assertEqual(t.render(items=[1], _pretty=False), '<ul><li class="c">1!</li></ul>')
+
+    def test_freeze(self):
+        t = div(id='x')(p(class_='a')('a'), Block('b'), hr).freeze()
+        self.assertRaises(TypeError, t, 'x')
+        self.assertRaises(TypeError, t.__setitem__, 'b', 'x')
+        self.assertRaises(TypeError, setattr, t, 'safe', True)
+        self.assertRaises(TypeError, setattr, t, 'attributes', {})
+        self.assertRaises(TypeError, t.attributes.__setitem__, 'id', 'y')
+        self.assertRaises(TypeError, t.children[0].attributes.update, {'class': 'b'})
+        # Tags without attributes of their own return a read-only copy.
+        self.assertRaises(TypeError, operator.setitem, t.children[1].attributes, 'x', 'y')
+        self.assertEqual(t.render(_pretty=False), '<div id="x"><p class="a">a</p><hr/></div>')
+
+        t2 = t.copy()
+        t2['b'] = 'b'
+        t2.attributes['id'] = 'y'
+        self.assertEqual(t2.render(_pretty=False), '<div id="y"><p class="a">a</p>b<hr/></div>')
+        self.assertEqual(t.render(_pretty=False), '<div id="x"><p class="a">a</p><hr/></div>')
+
+    def test_render_blocks(self):
+        t = html(body(Block('content')('default'), Block('footer'))).freeze()
+        blocks = {'content': [p(Var('x')), Block('inner')],
+                  'inner': lambda ctx: ctx['x'],
+                  'footer': ('a', 'b')}
+        filled = html(body(
+            Block('content')(p(Var('x')), Block('inner')(lambda ctx: ctx['x'])),
+            Block('footer')('a', 'b'),
+        ))
+        expected = filled.render(x=1)
+
+        self.assertEqualWS(t.render(x=1, _blocks=blocks), expected)
+        self.assertEqualWS(t.compile().render(x=1, _blocks=blocks), expected)
+        self.assertEqualWS(''.join(t.iter_render(x=1, _blocks=blocks, _chunk_size=1)), expected)
+        out = io.BytesIO()
+        t.compile().render_to(out, x=1, _blocks=blocks)
+        self.assertEqualWS(out.getvalue().decode('utf-8'), expected)
+        self.assertEqual(t.render(_pretty=False),
+                         '<!DOCTYPE html><html><body>default</body></html>')
+
+    def test_frozen_threads(self):
+        nav = ul([li(a(href='/%d' % i)('link %d' % i)) for i in range(20)])
+        t = html(
+            head(title(Var('title'))),
+            body(nav, Cached(p('cached'), key='title'), Block('content'),
+                 ul(ForEach('items', li(Var('item'), Block('suffix')))), table(Rows('rows'))),
+        ).freeze()
+        compiled = t.compile()
+
+        def render(i):
+            context = dict(title='page %d' % i, items=range(i % 5), rows=[(i, '<%d>' % i)])
+            blocks = {'content': div(Var('title')), 'suffix': '/%d' % i}
+            output = (t if i % 2 else compiled).render(_context=context, _blocks=blocks)
+            expected = t.copy()
+            expected['content'] = div(Var('title'))
+            expected['suffix'] = '/%d' % i
+            return output, expected.render(_context=context)
+
+        with ThreadPoolExecutor(16) as executor:
+            for output, expected in executor.map(render, range(500)):
+                self.assertEqualWS(output, expected)
+
+    def test_render_many(self):
+        t = ul(class_=lambda ctx: ctx['cls'])(lambda ctx: [li(i) for i in range(ctx['n'])])
+        contexts = [dict(cls='c%d' % n, n=n) for n in range(50)]
+        expected = [t.render(_context=c) for c in contexts]
+        self.assertEqual(list(render_many(t, contexts)), expected)
+        self.assertEqual(list(render_many(t.compile(), iter(contexts))), expected)
+        outputs = render_many(t, contexts, workers=2, chunksize=4)
+        self.assertEqual(list(outputs), expected)
+        compact = [t.render(_context=c, _pretty=False) for c in contexts]
+        self.assertEqual(list(render_many(t, contexts, workers=2, pretty=False)), compact)
+
+    def test_render_stats(self):
+        def items(ctx):
+            return [li(i) for i in range(3)]
+        t = html(body(div(Block('main')('x', ul(items))), div(div('<y>'))))
+        stats = RenderStats()
+        output = t.render(_stats=stats, _pretty=False)
+        expected = t.render(_pretty=False)
+        self.assertEqualWS(output, expected)
+
+        nodes = stats.nodes
+        self.assertEqual(sorted(nodes),
+                         ["Block('main')", 'body', 'div', 'html', 'items()', 'li', 'ul'])
+        self.assertEqual(nodes['div'].calls, 3)
+        self.assertEqual(nodes['li'].calls, 3)
+        self.assertEqual(nodes['html'].bytes, len(expected))
+        self.assertEqual(nodes['div'].bytes,
+                         len('<div>x<ul><li>0</li><li>1</li><li>2</li></ul></div>'
+                             '<div><div>&lt;y&gt;</div></div>'))
+        self.assertGreaterEqual(nodes['html'].inclusive, nodes['body'].inclusive)
+        exclusive = sum(node.exclusive for node in nodes.values())
+        self.assertAlmostEqual(exclusive, nodes['html'].inclusive)
+
+        lines = stats.collapsed().splitlines()
+        stacks = [line.split(' ')[0] for line in lines]
+        self.assertIn("html;body;div;Block('main');ul;items();li", stacks)
+        self.assertEqual(len(lines), 8)
+        self.assertIn('items()', str(stats))
+
+    def test_render_stats_generator(self):
+        def items(ctx):
+            for i in range(3):
+                yield li(b(i))
+        t = ul(items)
+        stats = RenderStats()
+        self.assertEqual(t.render(_stats=stats, _pretty=False), t.render(_pretty=False))
+
+        nodes = stats.nodes
+        self.assertEqual(sorted(nodes), ['b', 'items()', 'li', 'ul'])
+        self.assertEqual(nodes['li'].calls, 3)
+        self.assertEqual(nodes['li'].bytes, len('<li><b>0</b></li>') * 3)
+        self.assertIn('ul;items();li;b', stats.collapsed())
+
+    def test_render_stats_hook(self):
+        results = []
+        self.assertEqual(div(p('x')).render(_stats=results.append), '<div><p>x</p></div>')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].nodes['p'].calls, 1)
+
+    def test_memoize_static(self):
+        item = li('a')
+        menu = ul(item, li(b('b')))
+        calls = []
+        t = div(menu, lambda ctx: calls.append(1) or ctx['x'])
+        expected = '<div><ul><li>a</li><li><b>b</b></li></ul>1</div>'
+        for _ in range(3):
+            self.assertEqual(t.render(x='1', _pretty=False), expected)
+        self.assertEqual(calls, [1, 1, 1])
+        self.assertEqual(section(t).render(x='1'),
+                         section(div(ul(li('a'), li(b('b'))), '1')).render())
+
+        # Changes to a rendered tag invalidate memoized output.
+        item('c')
+        self.assertEqual(menu.render(_pretty=False), '<ul><li>c</li><li><b>b</b></li></ul>')
+        item.attributes['id'] = 'x'
+        self.assertEqual(menu.render(_pretty=False),
+                         '<ul><li id="x">c</li><li><b>b</b></li></ul>')
+        item.attributes = {}
+        self.assertEqual(menu.render(_pretty=False), '<ul><li>c</li><li><b>b</b></li></ul>')
+        item('<')
+        item.safe = True
+        self.assertEqual(menu.render(_pretty=False), '<ul><li><</li><li><b>b</b></li></ul>')
+
+    def test_memoize_lists_and_children(self):
+        items = ['a']
+        t = div(items)
+        t.render()
+        t.render()
+        items.append('b')
+        self.assertEqual(t.render(_pretty=False), '<div>ab</div>')
+
+        t = ul(li('a'))
+        t.render()
+        t.render()
+        t.children = (li('b'), )
+        self.assertEqual(t.render(_pretty=False), '<ul><li>b</li></ul>')
+        t.children = (li(Var('x')), )
+        self.assertEqual(t.render(x='c', _pretty=False), '<ul><li>c</li></ul>')
+        self.assertRaises(TypeError, setattr, t.freeze(), 'children', ())
+
+    def test_memoize_scoped(self):
+        item = li('a')
+        rows = div(*[p(i) for i in range(3)])
+        t = body(nav(ul(item)), rows)
+        t.render()
+        t.render()
+        memoized = rows._static_output(2, True)
+        self.assertIsNotNone(memoized)
+        for i in range(3):
+            item.attributes['class'] = str(i)
+            self.assertEqual(t.render(_pretty=False),
+                             '<body><nav><ul><li class="%d">a</li></ul></nav>'
+                             '<div><p>0</p><p>1</p><p>2</p></div></body>' % i)
+            # Output of tags which do not contain the changed tag is kept.
+            self.assertIs(rows._static_output(2, True), memoized)
+            # A tree changed before every render is not memoized again.
+            self.assertNotIsInstance(t._static, dict)
+
+    def test_memoize_becomes_dynamic(self):
+        item = li('a')
+        t = ul(item)
+        t.render()
+        t.render()
+        item(Var('x'))
+        self.assertEqual(t.render(x='1', _pretty=False), '<ul><li>1</li></ul>')
+        self.assertEqual(t.render(x='2', _pretty=False), '<ul><li>2</li></ul>')
+
+        item = li(id='a')('a')
+        t = ul(item)
+        t.render()
+        t.render()
+        item.attributes['id'] = lambda ctx: ctx['x']
+        self.assertEqual(t.render(x='1', _pretty=False), '<ul><li id="1">a</li></ul>')
+        self.assertEqual(t.render(x='2', _pretty=False), '<ul><li id="2">a</li></ul>')
+
+    def test_memoize_class_option(self):
+        t = div(em('<'))
+        t.render()
+        t.render()
+        try:
+            em.safe = True
+            self.assertEqual(t.render(_pretty=False), '<div><em><</em></div>')
+        finally:
+            em.safe = False
+        self.assertEqual(t.render(_pretty=False), '<div><em>&lt;</em></div>')
+
+    def test_memoize_copy(self):
+        t = div(id='a')(p('x'))
+        t.render()
+        t.render()
+        t2 = t.copy()
+        t2.attributes['id'] = 'b'
+        self.assertEqual(t.render(_pretty=False), '<div id="a"><p>x</p></div>')
+        self.assertEqual(t2.render(_pretty=False), '<div id="b"><p>x</p></div>')
+
+    def test_deep_blocks(self):
+        depth = 10000
+        t = div(Block('main'))
+        for i in range(depth):
+            t = div(Block('b%d' % i), t)
+        t = t.copy()
+        t['main'] = p(Block('main'))
+        t['main'] = 'x'
+        t['b0'] = 'y'
+        rendered = t.render(_pretty=False)
+        self.assertTrue(rendered.startswith('<div><div><div>'))
+        self.assertIn('<div>y<div><p>x</p></div></div>', rendered)
+
+    def test_blocks_after_call(self):
+        t = div(span(Block('a')))
+        t['a'] = 'a'
+        t(Block('b'))
+        self.assertEqual(t.blocks, {'b': list(t.children)})
+        t['b'] = 'b'
+        self.assertEqual(str(t), '<div>b</div>')
+
+    def test_blocks_filled_before_index(self):
+        b = Block('a')
+        t = div(b)
+        inner = Block('a')
+        b(p(inner), Block('c'))
+        self.assertEqual(t.blocks, {'a': [b], 'c': [b.children[1]]})
+
+    def test_nested_blocks_with_same_name(self):
+        t = div(Block('a')('outer', Block('a')('inner')))
+        t['a'] = 'X'
+        self.assertEqual(t.render(_pretty=False), '<div>X</div>')
+
+    def test_deep_dynamic_tree(self):
+        def nest(ctx):
+            t = Var('x')
+            for _ in range(10000):
+                t = div(lambda ctx, t=t: [t])
+            return t
+        rendered = span(nest).render(_pretty=False, x='<x>')
+        expected = '<div>' * 10000 + '&lt;x&gt;' + '</div>' * 10000
+        self.assertEqualWS(rendered, '<span>%s</span>' % expected)
+
     def test_block(self):
         f = lambda ctx: 'callable'
         x = div(
@@ -376,6 +1088,49 @@ qwerty</pre>
         d = div(name=f)
         self.assertEqual(str(d), '<div name="x"></div>')
 
+    def test_attributes_modified(self):
+        d = div(id='a', class_='x')
+        self.assertEqual(str(d), '<div class="x" id="a"></div>')
+        d.attributes['id'] = 'b'
+        self.assertEqual(str(d), '<div class="x" id="b"></div>')
+        del d.attributes['class_']
+        self.assertEqual(str(d), '<div id="b"></div>')
+        d.attributes.update(title='t')
+        self.assertEqual(str(d), '<div id="b" title="t"></div>')
+        d.attributes = {'lang': 'tr'}
+        self.assertEqual(str(d), '<div lang="tr"></div>')
+        d.attributes['lang'] = 'en'
+        self.assertEqual(str(d), '<div lang="en"></div>')
+
+    def test_attribute_object(self):
+        class Value(object):
+            text = 'a'
+
+            def __str__(self):
+                return self.text
+
+        value = Value()
+        d = div(title=value)
+        template = d.compile()
+        self.assertEqual(str(d), '<div title="a"></div>')
+        value.text = 'b'
+        self.assertEqual(str(d), '<div title="b"></div>')
+        self.assertEqual(template.render(), '<div title="b"></div>')
+
+    def test_lazy_attr_with_static_attrs(self):
+        counter = []
+        d = div(a='1', b=lambda ctx: counter.append(1) or len(counter), c='3')
+        self.assertEqual(str(d), '<div a="1" b="1" c="3"></div>')
+        self.assertEqual(str(d), '<div a="1" b="2" c="3"></div>')
+
+    def test_insertion_order_attributes(self):
+        d = div(z='1', a='2')
+        d.sort_attributes = False
+        if sys.version_info >= (3, 7):
+            self.assertEqual(str(d), '<div z="1" a="2"></div>')
+        d.sort_attributes = True
+        self.assertEqual(str(d), '<div a="2" z="1"></div>')
+
     def test_block_fill_multi(self):
         x = div(
             Block('b')('placeholder')
@@ -417,6 +1172,183 @@ qwerty</pre>
         )
         self.assertEqual( str(t), '<form method="POST"><input formaction="/test" formmethod="GET" type="submit"/></form>')  # noqa
 
+    def test_compile(self):
+        t = html(
+            head(title('title'), script(src='x.js')),
+            body(
+                div(class_='a', data_value='<b>')('div with\nsome\nnewlines'),
+                hr,
+                Safe('<br/>'),
+                pre('asdf\nzxcv'),
+                [p(i) for i in range(2)],
+                [1, None, u'T\xfcrk\xe7e'],
+            )
+        )
+        expected = t.render()
+        self.assertEqualWS(t.compile().render(), expected)
+        self.assertEqualWS(str(t.compile()), expected)
+
+    def test_compile_dynamic(self):
+        def rows(ctx):
+            for i in range(ctx['n']):
+                yield li(i)
+        t = div(id=lambda ctx: ctx['n'])(
+            p(Var('name', 'guest')),
+            ul(rows),
+            lambda ctx: [b('x'), 'y'],
+        )
+        compiled = t.compile()
+        for ctx in ({'n': 0}, {'n': 2, 'name': '<Cenk>'}):
+            self.assertEqualWS(compiled.render(**ctx), t.render(**ctx))
+
+    def test_compile_block(self):
+        t = div(p(Block('b')('placeholder')))
+        compiled = t.compile()
+        self.assertEqualWS(compiled.render(), t.render())
+        t['b'] = lambda ctx: 'filled'
+        self.assertEqualWS(compiled.render(), t.render())
+        self.assertEqual(compiled.render(), '<div><p>filled</p></div>')
+
+    def test_compile_codegen(self):
+        values = ['text', 'a\nb', 'a\rb\n', '', '<&>', 1, 1.5, None, ['a', 'b'], [p('x'), 'y'],
+                  b('bold'), hr, (i for i in range(2)), Safe('<x>')]
+        t = html(
+            head(title(Var('v'))),
+            body(
+                div(class_=Var('v'), id='x', data_n=lambda ctx: 1)(Var('v')),
+                p(Var('v'), ' ', lambda ctx: ctx['v']),
+                pre(Var('v')),
+                script(Var('v')),
+                Block('b'),
+                Safe(Var('v')),
+            )
+        )
+        t['b'] = span(Var('v'))
+        for pretty in (True, False):
+            compiled = t.compile(pretty=pretty)
+            self.assertIn('def render(out, context, blocks=None)', compiled.source)
+            for value in values:
+                if isinstance(value, GeneratorType):
+                    continue
+                self.assertEqualWS(compiled.render(v=value), t.render(v=value, _pretty=pretty))
+            value = lambda ctx: (i for i in range(2))
+            self.assertEqualWS(compiled.render(v=value), t.render(v=value, _pretty=pretty))
+
+    def test_compile_cache(self):
+        def build(heading):
+            t = html(body(h1(heading), div(class_=lambda ctx: ctx['c'], id='x')(Var('v')),
+                          ul(lambda ctx: (li(i) for i in ctx['items'])), Block('b')))
+            t['b'] = p(Var('v'), lambda ctx: ctx['c'])
+            return t
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = TemplateCache(directory)
+        context = dict(c='<c>', v='v', items=[1, 2])
+
+        t = build('a')
+        first = t.compile(cache=cache)
+        self.assertEqual(len(os.listdir(directory)), 1)
+        t = build('a')
+        loaded = t.compile(cache=cache)
+        self.assertEqual(loaded.source, first.source)
+        self.assertEqualWS(loaded.render(**context), t.render(**context))
+
+        # A different tree gets its own entry.
+        t = build('b')
+        self.assertEqualWS(t.compile(cache=cache).render(**context), t.render(**context))
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+    def test_compile_cache_tag_name(self):
+        class foo(Tag):
+            pass
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = TemplateCache(directory)
+        foo(Var('v')).compile(cache=cache)
+        foo.name = 'bar'
+        t = foo(Var('v'))
+        self.assertEqual(t.compile(cache=cache).render(v=1), t.render(v=1))
+        self.assertEqualWS(t.render(v=1, _pretty=False), '<bar>1</bar>')
+
+    def test_compile_cache_corrupt(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = TemplateCache(directory)
+        t = div(p(Var('v')))
+        with open(cache.path(t, True), 'wb') as f:
+            f.write(b'garbage')
+        self.assertEqualWS(t.compile(pretty=True, cache=cache).render(v=1), t.render(v=1))
+        self.assertEqualWS(t.compile(pretty=True, cache=cache).render(v=2), t.render(v=2))
+
+    def test_compile_merges_static_chunks(self):
+        t = div(p('a'), p(Var('x')), p('c'))
+        self.assertEqual(len(t.compile().chunks), 3)
+
+    def test_iter_render(self):
+        t = html(
+            head(title(Var('title'))),
+            body(
+                pre('a\nb'),
+                Block('b')('x', hr),
+                Safe('<br/>'),
+                ul(lambda ctx: (li(i) for i in range(3))),
+            )
+        )
+        chunks = list(t.iter_render(title='t', _chunk_size=1))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqualWS(''.join(chunks), t.render(title='t'))
+        self.assertEqualWS(''.join(t.iter_render(title='t')), t.render(title='t'))
+
+    def test_iter_render_encoding(self):
+        t = div(p(u'Türkçe'), lambda ctx: (p(i) for i in range(100)))
+        chunks = list(t.iter_render(_chunk_size=100, _encoding='utf-8'))
+        self.assertTrue(all(isinstance(chunk, bytes) for chunk in chunks))
+        self.assertEqualWS(b''.join(chunks).decode('utf-8'), t.render())
+
+    def test_render_to(self):
+        t = html(body(h1(Var('title')), ul(lambda ctx: (li(i) for i in range(1000)))))
+        expected = t.render(title=u'Türkçe').encode('utf-8')
+        for target in (t, t.compile()):
+            writes = []
+            out = io.BytesIO()
+
+            def write(b, write=out.write, writes=writes):
+                writes.append(len(b))
+                return write(b)
+            out.write = write
+            target.render_to(out, _chunk_size=1000, title=u'Türkçe')
+            self.assertEqualWS(out.getvalue(), expected)
+            self.assertTrue(all(size >= 1000 for size in writes[:-1]), writes)
+            self.assertTrue(len(writes) > 1)
+
+    def test_render_to_ascii(self):
+        t = div(title=u'ç')(u'Türkçe <b>')
+        expected = b'<div title="&#231;">T&#252;rk&#231;e &lt;b&gt;</div>'
+        out = io.BytesIO()
+        t.render_to(out, 'ascii', _pretty=False)
+        self.assertEqualWS(out.getvalue(), expected)
+        out = io.BytesIO()
+        t.compile(pretty=False).render_to(out, 'ascii')
+        self.assertEqualWS(out.getvalue(), expected)
+
+    def test_iter_render_chunk_size(self):
+        t = div((p('x') for _ in range(1000)))
+        chunks = list(t.iter_render(_chunk_size=100))
+        self.assertTrue(all(len(chunk) >= 100 for chunk in chunks[:-1]))
+
+    def test_iter_render_lazy(self):
+        consumed = []
+
+        def rows(ctx):
+            for i in range(1000):
+                consumed.append(i)
+                yield tr(td(i))
+        chunks = table(rows).iter_render(_chunk_size=10)
+        next(chunks)
+        self.assertTrue(len(consumed) < 10)
+
 
 if __name__ == "__main__":
     unittest.main()
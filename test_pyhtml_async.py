@@ -0,0 +1,143 @@
+import asyncio
+import unittest
+import warnings
+
+from pyhtml import *
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def collect(agen):
+    return [chunk async for chunk in agen]
+
+
+class TestPyHTMLAsync(unittest.TestCase):
+
+    def test_render_async_sync_tree(self):
+        t = html(
+            head(title(Var('title'))),
+            body(
+                div(class_='a', id=lambda ctx: 'x')('a\nb'),
+                pre('a\nb'),
+                Block('b')('x', hr),
+                Safe('<br/>'),
+                ul(lambda ctx: (li(i) for i in range(3))),
+            )
+        )
+        self.assertEqual(run(t.render_async(title='t')), t.render(title='t'))
+        self.assertEqual(run(t.render_async(title='t', _pretty=False)),
+                         t.render(title='t', _pretty=False))
+
+    def test_coroutine_child(self):
+        async def greet(ctx):
+            await asyncio.sleep(0)
+            return b('Hello %s' % ctx['name'])
+        t = div(p(greet))
+        self.assertEqual(run(t.render_async(name='<Cenk>')),
+                         div(p(b('Hello <Cenk>'))).render())
+
+    def test_coroutine_attribute(self):
+        async def cls(ctx):
+            return 'big'
+        t = div(class_=cls, id='x')
+        self.assertEqual(run(t.render_async()), '<div class="big" id="x"></div>')
+
+    def test_async_generator_child(self):
+        async def items(ctx):
+            for i in range(3):
+                await asyncio.sleep(0)
+                yield li(i)
+        t = ul(items)
+        expected = ul([li(i) for i in range(3)]).render()
+        self.assertEqual(run(t.render_async()), expected)
+
+    def test_cached(self):
+        calls = []
+
+        async def nav(ctx):
+            calls.append(ctx['role'])
+            return a(ctx['role'])
+        t = div(Cached(nav, key='role'))
+        self.assertEqual(run(t.render_async(role='x')), div(a('x')).render())
+        self.assertEqual(run(t.render_async(role='x')), div(a('x')).render())
+        self.assertEqual(t.render(role='x'), div(a('x')).render())
+        self.assertEqual(calls, ['x'])
+
+    def test_parallel(self):
+        t = div(Parallel(p('a'), lambda ctx: p(ctx['x'])), Parallel())
+        self.assertEqual(run(t.render_async(x='b')), t.render(x='b'))
+
+    def test_rows(self):
+        t = table(Rows('rows'))
+        rows = [(1, '<a>'), (2, None)]
+        self.assertEqual(run(t.render_async(rows=rows)), t.render(rows=rows))
+
+    def test_for_each(self):
+        t = ul(ForEach('items', li(Var('item'), Var('x'))))
+        self.assertEqual(run(t.render_async(items=[1, 2], x='x')), t.render(items=[1, 2], x='x'))
+
+    def test_coroutine_in_for_each(self):
+        async def greet(ctx):
+            return ctx['item']
+        t = ul(ForEach('items', li(greet)))
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            with self.assertRaises(TypeError):
+                run(t.render_async(items=[1]))
+            t = table(Rows('rows'))
+            with self.assertRaises(TypeError):
+                run(t.render_async(rows=[(greet({'item': 1}),)]))
+
+    def test_render_blocks(self):
+        async def content(ctx):
+            return p(ctx['x'])
+        t = div(Block('a'), Block('b')('default')).freeze()
+        blocks = {'a': content}
+        self.assertEqual(run(t.render_async(x=1, _blocks=blocks)),
+                         t.render(x=1, _blocks={'a': p(1)}))
+
+    def test_cached_blocks(self):
+        async def content(ctx):
+            return ctx['x']
+        t = div(Cached(p(Block('a')))).freeze()
+        for x in (1, 2):
+            self.assertEqual(run(t.render_async(x=x, _blocks={'a': content}, _pretty=False)),
+                             '<div><p>%d</p></div>' % x)
+
+    def test_siblings_are_concurrent(self):
+        async def test():
+            event = asyncio.Event()
+
+            async def first(ctx):
+                # Would block forever if siblings ran one after another.
+                await event.wait()
+                return 'first'
+
+            async def second(ctx):
+                event.set()
+                return 'second'
+
+            t = div(div(first), div(second))
+            return await asyncio.wait_for(t.render_async(), 1)
+        self.assertEqual(run(test()), div(div('first'), div('second')).render())
+
+    def test_aiter_render(self):
+        async def rows(ctx):
+            for i in range(100):
+                yield tr(td(i))
+        t = table(rows)
+        chunks = run(collect(t.aiter_render(_chunk_size=50)))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(len(chunk) >= 50 for chunk in chunks[:-1]))
+        expected = table([tr(td(i)) for i in range(100)]).render()
+        self.assertEqual(''.join(chunks), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()